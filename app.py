@@ -1,22 +1,105 @@
 import streamlit as st
 import streamlit.components.v1 as components
-import sqlite3
 import pandas as pd
+import numpy as np
 import base64
+import json
 import os
+import shutil
+import tempfile
+from db_pool import VersionedPool
+from migrations import SCHEMA_VERSION, database_version, migrate_database
+from nutrient_matrix import open_nutrient_matrix
+from nutrient_vector import NutrientVector, mix_per_100g
+from nutrition_db import (
+    DB_PATH, FIELDS_MAPPING, SEARCH_COUNT_CAP, SEARCH_PAGE_SIZE, ProductCatalog, RetentionMatrix, advanced_search_sql, like_search_sql,
+    name_candidates_sql, products_by_codes_sql, query_available_units, query_recipe_details,
+    read_db_version
+)
+from prefetch import Prefetcher
+from query_cache import MISSING, QueryCache
+from sig_figs import count_sig_figs_array, display_values, scale_with_sig_figs, to_float_array
+from hebrew_search import CodeIndex, FuzzyIndex, IncrementalSearch, build_autocomplete_catalog, is_code_query, search_index_exists
 
 # Page configuration
 st.set_page_config(page_title="מחשבון תזונתי", page_icon="🍎", layout="wide")
 
+# Browser-side product autocomplete: the static frontend is served together with
+# a generated catalog.json from a writable directory next to the database, so a
+# read-only install never has files written into it
+AUTOCOMPLETE_FRONTEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "food_autocomplete", "index.html")
+AUTOCOMPLETE_DIR = os.path.abspath(f"{DB_PATH}.autocomplete")
+
 # Database connection
+DB_POOL_SIZE = 8
+
+# Upgrade an older nutrition.db on startup instead of refusing to run
+AUTO_MIGRATE = True
+
+@st.cache_resource(max_entries=1)
+def check_schema(db_version):
+    """Error message if a database build does not match this code's schema, else None.
+
+    With AUTO_MIGRATE an older build is migrated and swapped in; the next
+    read_db_version() then sees the new build.
+    """
+    try:
+        version = database_version(DB_PATH)
+        if version == SCHEMA_VERSION:
+            return None
+        if version > SCHEMA_VERSION:
+            return f"מסד הנתונים בגרסת סכימה {version}, חדשה מגרסת הקוד ({SCHEMA_VERSION}). יש לעדכן את האפליקציה."
+        if not AUTO_MIGRATE:
+            return f"מסד הנתונים בגרסת סכימה {version}, נדרשת גרסה {SCHEMA_VERSION}. יש להריץ: python migrations.py"
+        migrate_database(DB_PATH)
+        return None
+    except Exception as e:
+        return f"שגיאה בבדיקת מסד הנתונים: {e}"
+
+@st.cache_resource(on_release=VersionedPool.close)
+def get_versioned_pool():
+    """Connection pools of nutrition.db, one build at a time, shared by every session"""
+    return VersionedPool(DB_PATH, max_connections=DB_POOL_SIZE)
+
+def get_pool(db_version):
+    """Read-only connection pool for a build of nutrition.db (the current one for a replaced build)"""
+    return get_versioned_pool().pool(db_version)
+
+def db_connection():
+    """Check out a pooled connection to the current database build (use as a with block)"""
+    return get_pool(get_db_version()).connection()
+
+# Shared cache of query results (also filled by the prefetcher)
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+QUERY_CACHE_TTL_SECONDS = 30 * 60
+
 @st.cache_resource
-def get_connection():
-    """Create database connection"""
-    return sqlite3.connect('nutrition.db', check_same_thread=False)
+def get_query_cache():
+    """Query-result cache shared by every session"""
+    return QueryCache(max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL_SECONDS)
+
+def cached_query(name, args, load):
+    """Serve load() from the query cache, keyed on name, arguments and the database version"""
+    cache = get_query_cache()
+    db_version = get_db_version()
+    cache.ensure_version(db_version)
+    return cache.get_or_load((name, db_version, args), load)
+
+def read_sql_cached(query, params=()):
+    """pd.read_sql_query through the query cache"""
+    params = tuple(params)
+    def load():
+        with db_connection() as conn:
+            return pd.read_sql_query(query, conn, params=list(params))
+    return cached_query('sql', (query, params), load)
 
 
 # Global Constants
 # Global Constants
+# Background prefetch of units and recipe components for the top search hits
+PREFETCH_TOP_K = 5
+PREFETCH_WORKERS = 2
+
 def get_base64_image(image_path):
     """Read image file and return base64 string"""
     try:
@@ -25,324 +108,333 @@ def get_base64_image(image_path):
     except Exception as e:
         return None
 
-FIELDS_MAPPING = {
-    # Macronutrients
-    'food_energy': 'קלוריות (קק"ל)',
-    'protein': 'חלבון (גרם)',
-    'total_fat': 'שומן כולל (גרם)',
-    'carbohydrates': 'פחמימות (גרם)',
-    'total_dietary_fiber': 'סיבים תזונתיים (גרם)',
-    'total_sugars': 'סוכרים (גרם)',
-    'alcohol': 'אלכוהול (גרם)',
-    'moisture': 'לחות (גרם)',
-    
-    # Fats
-    'saturated_fat': 'שומן רווי (גרם)',
-    'mono_unsaturated_fat': 'שומן חד בלתי רווי (גרם)',
-    'poly_unsaturated_fat': 'שומן רב בלתי רווי (גרם)',
-    'trans_fatty_acids': 'שומן טרנס (גרם)',
-    'cholesterol': 'כולסטרול (מ"ג)',
-    'linoleic': 'חומצה לינולאית (אומגה 6) (גרם)',
-    'linolenic': 'חומצה לינולנית (אומגה 3) (גרם)',
-    'oleic': 'חומצה אולאית (גרם)',
-    'docosahexanoic': 'DHA (גרם)',
-    'eicosapentaenoic': 'EPA (גרם)',
-    'arachidonic': 'חומצה ארכידונית (גרם)',
-    
-    # Vitamins
-    'vitamin_a_iu': 'ויטמין A (יחב"ל)',
-    'vitamin_a_re': 'ויטמין A (מק"ג RE)',
-    'carotene': 'קרוטן (מק"ג)',
-    'vitamin_e': 'ויטמין E (מ"ג)',
-    'vitamin_c': 'ויטמין C (מ"ג)',
-    'thiamin': 'תיאמין B1 (מ"ג)',
-    'riboflavin': 'ריבופלאבין B2 (מ"ג)',
-    'niacin': 'ניאצין B3 (מ"ג)',
-    'vitamin_b6': 'ויטמין B6 (מ"ג)',
-    'folate': 'חומצה פולית (מק"ג)',
-    'vitamin_b12': 'ויטמין B12 (מק"ג)',
-    'vitamin_d': 'ויטמין D (מק"ג)',
-    'vitamin_k': 'ויטמין K (מק"ג)',
-    'pantothenic_acid': 'חומצה פנטותנית (מ"ג)',
-    'biotin': 'ביוטין (מק"ג)',
-    'choline': 'כולין (מ"ג)',
-    
-    # Minerals
-    'calcium': 'סידן (מ"ג)',
-    'iron': 'ברזל (מ"ג)',
-    'magnesium': 'מגנזיום (מ"ג)',
-    'phosphorus': 'זרחן (מ"ג)',
-    'potassium': 'אשלגן (מ"ג)',
-    'sodium': 'נתרן (מ"ג)',
-    'zinc': 'אבץ (מ"ג)',
-    'copper': 'נחושת (מ"ג)',
-    'manganese': 'מנגן (מ"ג)',
-    'selenium': 'סלניום (מק"ג)',
-    'iodine': 'יוד (מק"ג)',
-    
-    # Amino Acids
-    'isoleucine': 'איזולאוצין (גרם)',
-    'leucine': 'לאוצין (גרם)',
-    'valine': 'ואלין (גרם)',
-    'lysine': 'ליזין (גרם)',
-    'methionine': 'מתיונין (גרם)',
-    'phenylalanine': 'פנילאלנין (גרם)',
-    'threonine': 'תראונין (גרם)',
-    'tryptophan': 'טריפטופן (גרם)',
-    'histidine': 'היסטידין (גרם)',
-    'arginine': 'ארגינין (גרם)',
-    
-    # Other
-    'fructose': 'פרוקטוז (גרם)',
-    'sugar_alcohols': 'רב כהלים (גרם)'
-}
-
-def count_sig_figs(value):
-    """Count significant figures of a number"""
-    if value is None:
-        return 0
-    
-    # Convert to string
-    s = str(value).lower()
-    
-    # Handle scientific notation
-    if 'e' in s:
-        base, _ = s.split('e')
-        return count_sig_figs(base)
-    
-    # Remove negative sign
-    s = s.replace('-', '')
-    
-    # Remove decimal point
-    s_no_decimal = s.replace('.', '')
-    
-    # Strip leading zeros
-    s_stripped = s_no_decimal.lstrip('0')
-    
-    if not s_stripped:
-        return 0
-        
-    return len(s_stripped)
+def empty_search_results():
+    """Empty search result frame with the columns callers expect"""
+    return pd.DataFrame(columns=['Code', 'smlmitzrach', 'shmmitzrach'])
+
+@st.cache_resource(max_entries=1)
+def get_code_index(db_version):
+    """Build the sorted smlmitzrach/Code key array once per server process"""
+    with db_connection() as conn:
+        return CodeIndex(conn.execute("SELECT Code, smlmitzrach FROM products").fetchall())
 
-def round_to_sig_figs(x, sig_figs):
-    """Round a number to a specific number of significant figures"""
-    if x == 0:
-        return 0
+def get_products_by_codes(codes):
+    """Fetch Code, smlmitzrach and shmmitzrach for the given codes, keeping their order"""
+    if not codes:
+        return empty_search_results()
+    
+    df = read_sql_cached(*products_by_codes_sql(codes))
+    found = set(df['Code'])
+    return df.set_index('Code').loc[[c for c in codes if c in found]].reset_index()
+
+def like_name_search(search_term, page, page_size, recipes_only=False):
+    """Ranked LIKE scan for databases built before the search index existed; returns (results, total)"""
+    query, params, count_query, count_params = like_search_sql(
+        search_term, page, page_size, recipes_only, SEARCH_COUNT_CAP
+    )
+    def count():
+        with db_connection() as conn:
+            return conn.execute(count_query, count_params).fetchone()[0]
+    results = read_sql_cached(query, params)
+    total = cached_query('count', (count_query, tuple(count_params)), count)
+    return results, total
+
+def fetch_name_candidates(search_term, recipes_only=False):
+    """Fetch every ranked FTS match (up to the count cap) with the indexed text needed to re-filter it"""
+    sql = name_candidates_sql(search_term, recipes_only, SEARCH_COUNT_CAP)
+    if sql is None:
+        return pd.DataFrame(columns=['Code', 'smlmitzrach', 'shmmitzrach', 'match_name', 'stems', 'score'])
     
-    import math
-    try:
-        return round(x, sig_figs - int(math.floor(math.log10(abs(x)))) - 1)
-    except (ValueError, OverflowError):
-        return x
+    return read_sql_cached(*sql)
 
-def calculate_with_sig_figs(original_value, factor):
-    """Calculate new value preserving significant figures"""
-    if original_value is None:
-        return 0
+def ranked_name_search(search_term, page=0, page_size=SEARCH_PAGE_SIZE, recipes_only=False, state=None):
+    """Page through name matches ranked exact > prefix > word-start > substring; returns (results, total)"""
+    def index_exists():
+        with db_connection() as conn:
+            return search_index_exists(conn)
+    if not cached_query('search_index_exists', (), index_exists):
+        return like_name_search(search_term, page, page_size, recipes_only)
+    
+    # An extended query narrows the session's previous candidates without touching SQLite
+    db_version = get_db_version()
+    if state is not None and state.can_narrow(search_term, db_version):
+        candidates = state.narrow(search_term)
+    else:
+        candidates = fetch_name_candidates(search_term, recipes_only)
+    if state is not None:
+        state.remember(search_term, candidates, complete=len(candidates) <= SEARCH_COUNT_CAP, db_version=db_version)
     
+    page_rows = candidates.iloc[page * page_size:(page + 1) * page_size]
+    return page_rows[['Code', 'smlmitzrach', 'shmmitzrach']].reset_index(drop=True), len(candidates)
+
+def search_foods(search_term, page=0, page_size=SEARCH_PAGE_SIZE, state=None):
+    """Search for foods by smlmitzrach/Code (exact, then prefix) or by ranked name; returns (results, total)"""
+    # Numeric input is answered from the in-memory code index before any name search
+    if is_code_query(search_term):
+        codes = get_code_index(get_db_version()).lookup(search_term.strip())
+        if codes:
+            page_codes = codes[page * page_size:(page + 1) * page_size]
+            return get_products_by_codes(page_codes), len(codes)
+    
+    return ranked_name_search(search_term, page, page_size, state=state)
+
+@st.cache_resource(max_entries=1)
+def get_fuzzy_index(db_version):
+    """Build the typo-tolerant product-name index once per server process"""
+    with db_connection() as conn:
+        return FuzzyIndex(conn.execute("SELECT Code, shmmitzrach FROM products").fetchall())
+
+def fuzzy_search_foods(search_term, limit=20):
+    """Return the products whose names are closest to the search term by edit distance"""
+    matches = get_fuzzy_index(get_db_version()).search(search_term, limit=limit)
+    # Keep the edit-distance order
+    return get_products_by_codes([code for code, _, _ in matches])
+
+def search_foods_with_fallback(search_term, page=0, page_size=SEARCH_PAGE_SIZE, state=None):
+    """Search foods; when nothing matches, fall back to typo-tolerant suggestions"""
+    results, total = search_foods(search_term, page, page_size, state=state)
+    if total == 0:
+        results = fuzzy_search_foods(search_term)
+        total = len(results)
+        if total > 0:
+            st.caption("🔎 לא נמצאה התאמה מדויקת - מוצגות תוצאות דומות")
+    return results, total
+
+def search_recipes(search_term, page=0, page_size=SEARCH_PAGE_SIZE, state=None):
+    """Search for products that have a recipe, by ranked name; returns (results, total)"""
+    return ranked_name_search(search_term, page, page_size, recipes_only=True, state=state)
+
+def format_result_count(total):
+    """Format a result count, marking capped counts as estimates"""
+    return f"{SEARCH_COUNT_CAP}+" if total > SEARCH_COUNT_CAP else str(total)
+
+def paged_search(search_fn, search_term, key):
+    """Run a search one page at a time, rendering a page picker; returns (results, total)"""
+    # A new search term starts again from the first page
+    if st.session_state.get(f"{key}_term") != search_term:
+        st.session_state[f"{key}_term"] = search_term
+        st.session_state[f"{key}_page"] = 1
+    page = st.session_state.get(f"{key}_page", 1)
+    
+    # Each search box keeps its own incremental state for search-as-you-type
+    if f"{key}_incremental" not in st.session_state:
+        st.session_state[f"{key}_incremental"] = IncrementalSearch()
+    
+    results, total = search_fn(search_term, page=page - 1, state=st.session_state[f"{key}_incremental"])
+    
+    # The user almost always picks one of the first hits
+    prefetch_top_hits(results)
+    
+    num_pages = max(1, -(-min(total, SEARCH_COUNT_CAP) // SEARCH_PAGE_SIZE))
+    if num_pages > 1:
+        st.number_input(
+            f"עמוד תוצאות (מתוך {num_pages}):",
+            min_value=1,
+            max_value=num_pages,
+            step=1,
+            key=f"{key}_page"
+        )
+    return results, total
+
+def get_db_version():
+    """Database build this script run reads from, fixed when the run starts"""
+    return st.session_state.get('db_version') or read_db_version()
+
+def write_atomic(path, write):
+    """Write a file through a temp file of this process, so readers and other writers only ever see whole files"""
+    f = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path), suffix=".tmp", delete=False)
     try:
-        val_float = float(original_value)
-        if val_float == 0:
-            return 0
-            
-        # Count sig figs from the original representation
-        # If it's an integer in DB (e.g. 24), it comes as 24 or 24.0 depending on pandas
-        # We should try to respect the input type if possible, but here we have values.
-        # We'll use the string representation of the input value.
-        sig_figs = count_sig_figs(original_value)
-        
-        # If sig_figs is 0 (e.g. input was 0), return 0
-        if sig_figs == 0:
-            return 0
-            
-        new_val = val_float * factor
-        rounded_val = round_to_sig_figs(new_val, sig_figs)
-        
-        # Format logic:
-        # If the result is an integer (e.g. 10.0) and original was int-like, maybe show int?
-        # But 10.0 has 3 sig figs, 10 has 2.
-        # We should return a string that represents the sig figs.
-        # However, standard float formatting might be enough for now.
-        # Let's return the rounded float.
-        return rounded_val
-        
-    except (ValueError, TypeError):
-        return 0
-
-def search_foods(search_term):
-    """Search for foods by name or smlmitzrach code"""
-    conn = get_connection()
-    query = """
-    SELECT Code, smlmitzrach, shmmitzrach 
-    FROM products 
-    WHERE shmmitzrach LIKE ? OR CAST(smlmitzrach AS TEXT) LIKE ?
-    ORDER BY shmmitzrach
-    """
-    df = pd.read_sql_query(query, conn, params=(f'%{search_term}%', f'%{search_term}%'))
-    return df
+        with f:
+            write(f)
+        # Temp files are created private; the served copies are ordinary readable files
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+        raise
 
-def advanced_search(conditions, columns=None):
-    """Advanced search with multiple conditions and individual AND/OR operators"""
-    conn = get_connection()
-    
-    if not conditions:
-        return pd.DataFrame()
-    
-    # Build WHERE clause with individual operators
-    where_parts = []
-    params = []
-    
-    for i, cond in enumerate(conditions):
-        field = cond['field']
-        operator = cond['operator']
-        value = cond['value']
-        
-        # Build condition SQL
-        if operator == 'שווה' or operator == '=':
-            condition_sql = f"{field} = ?"
-            params.append(value)
-        elif operator == 'גדול מ' or operator == '>':
-            condition_sql = f"{field} > ?"
-            params.append(value)
-        elif operator == 'קטן מ' or operator == '<':
-            condition_sql = f"{field} < ?"
-            params.append(value)
-        elif operator == 'גדול שווה' or operator == '>=':
-            condition_sql = f"{field} >= ?"
-            params.append(value)
-        elif operator == 'קטן שווה' or operator == '<=':
-            condition_sql = f"{field} <= ?"
-            params.append(value)
-        elif operator == 'בין':
-            if 'value2' in cond:
-                condition_sql = f"{field} BETWEEN ? AND ?"
-                params.extend([value, cond['value2']])
-            else:
-                continue
-        else:
-            continue
-        
-        # Add to parts with logic operator
-        if i == 0:
-            where_parts.append(condition_sql)
-        else:
-            # Get the logic operator from the previous condition
-            logic_op = conditions[i-1].get('next_operator', 'AND')
-            where_parts.append(f" {logic_op} {condition_sql}")
+@st.cache_resource
+def get_autocomplete_component():
+    """Copy the autocomplete frontend into its serving directory and declare the component, once per process"""
+    os.makedirs(AUTOCOMPLETE_DIR, exist_ok=True)
+    with open(AUTOCOMPLETE_FRONTEND, encoding="utf-8") as source:
+        write_atomic(os.path.join(AUTOCOMPLETE_DIR, "index.html"), lambda f: shutil.copyfileobj(source, f))
+    return components.declare_component("food_autocomplete", path=AUTOCOMPLETE_DIR)
+
+@st.cache_resource
+def publish_autocomplete_catalog(db_version):
+    """Write the browser autocomplete catalog for a database build, once per process and build"""
+    with get_pool(db_version).connection() as conn:
+        products = conn.execute("SELECT Code, smlmitzrach, shmmitzrach FROM products").fetchall()
+    catalog = build_autocomplete_catalog(products, db_version)
+    
+    get_autocomplete_component()
+    write_atomic(
+        os.path.join(AUTOCOMPLETE_DIR, "catalog.json"),
+        lambda f: json.dump(catalog, f, ensure_ascii=False, separators=(",", ":"))
+    )
+    return db_version
+
+def food_autocomplete(label, key, placeholder=""):
+    """Browser-side autocomplete; returns {'code', 'name'}, {'query'} (Enter with no match) or None"""
+    version = publish_autocomplete_catalog(get_db_version())
+    return get_autocomplete_component()(label=label, placeholder=placeholder, version=version, key=key, default=None)
+
+def food_picker(label, key, placeholder=""):
+    """Let the user pick a product; returns (code, name) or (None, None)"""
+    if st.session_state.get("client_autocomplete", True):
+        selection = food_autocomplete(label, key=key, placeholder=placeholder)
+        if not selection:
+            return None, None
+        if 'code' in selection:
+            return selection['code'], selection['name']
+        # Nothing matched in the browser: let the server look for similar names
+        search_term = selection['query']
+    else:
+        search_term = st.text_input(label, placeholder=placeholder, key=f"{key}_text")
     
-    if not where_parts:
-        return pd.DataFrame()
+    if not search_term:
+        return None, None
     
-    # Combine all parts
-    where_clause = "".join(where_parts)
+    results, total = paged_search(search_foods_with_fallback, search_term, key=f"{key}_results")
+    if len(results) == 0:
+        st.warning("לא נמצאו תוצאות. נסה חיפוש אחר.")
+        return None, None
     
-    # Determine columns to select
-    if columns:
-        # Ensure Code and shmmitzrach are always present
-        cols_to_select = ['Code', 'shmmitzrach'] + [c for c in columns if c not in ['Code', 'shmmitzrach']]
-        select_clause = ", ".join(cols_to_select)
-    else:
-        select_clause = "Code, shmmitzrach, protein, total_fat, carbohydrates, food_energy"
+    st.caption(f"נמצאו {format_result_count(total)} תוצאות")
+    food_options = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
+    selected_name = st.selectbox("בחר מזון:", options=list(food_options.keys()), key=f"{key}_select")
+    return food_options[selected_name], selected_name
 
-    query = f"""
-    SELECT {select_clause}
-    FROM products 
-    WHERE {where_clause}
-    ORDER BY shmmitzrach
-    """
+def advanced_search(conditions, columns=None):
+    """Advanced search with multiple conditions and individual AND/OR operators"""
+    sql = advanced_search_sql(conditions, columns)
+    if sql is None:
+        return pd.DataFrame()
     
-    df = pd.read_sql_query(query, conn, params=params)
+    query, params = sql
+    with db_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
     return df
 
+@st.cache_resource
+def get_prefetcher():
+    """Shared background prefetcher for per-product lookups"""
+    return Prefetcher(
+        loaders={
+            'units': query_available_units,
+            'recipe': query_recipe_details,
+        },
+        cache=get_query_cache(),
+        max_workers=PREFETCH_WORKERS
+    )
+
+def prefetch_top_hits(results):
+    """Warm units and recipe components for the first hits of a search"""
+    prefetcher = get_prefetcher()
+    db_version = get_db_version()
+    prefetcher.ensure_version(db_version, get_pool(db_version).connection)
+    prefetcher.prefetch(results['Code'].head(PREFETCH_TOP_K).tolist())
+
+def get_prefetched(name, code):
+    """Serve a per-product lookup from the prefetch cache, loading it on a miss"""
+    prefetcher = get_prefetcher()
+    db_version = get_db_version()
+    prefetcher.ensure_version(db_version, get_pool(db_version).connection)
+    return prefetcher.get(name, code)
+
+@st.cache_resource(max_entries=1)
+def get_product_catalog(db_version):
+    """All products loaded once per database build and shared by every session"""
+    with get_pool(db_version).connection() as conn:
+        return ProductCatalog(conn)
+
+@st.cache_resource(max_entries=1)
+def get_nutrient_matrix(db_version):
+    """Memory-mapped products × nutrients snapshot of a database build (see nutrient_matrix.py)"""
+    with get_pool(db_version).connection() as conn:
+        return open_nutrient_matrix(conn, db_version, DB_PATH)
+
+@st.cache_resource(max_entries=1)
+def get_retention_matrix(db_version):
+    """Every cooking method's retention multipliers, loaded once per database build"""
+    with get_pool(db_version).connection() as conn:
+        return RetentionMatrix(conn)
+
 def get_food_details(food_code):
     """Get nutritional details for a specific food"""
-    conn = get_connection()
-    query = """
-    SELECT * 
-    FROM products 
-    WHERE Code = ?
-    """
-    df = pd.read_sql_query(query, conn, params=(food_code,))
-    return df.iloc[0] if len(df) > 0 else None
+    return get_product_catalog(get_db_version()).get(food_code)
+
+def product_nutrient_rows(food_codes):
+    """float64 FIELDS_MAPPING rows of several foods (missing values and unknown codes are 0)"""
+    values, missing, _ = get_nutrient_matrix(get_db_version()).take(food_codes)
+    return np.where(missing, 0.0, values)
 
 def get_available_units(food_code):
     """Get available units for a specific food"""
-    conn = get_connection()
-    query = """
-    SELECT c.mida, c.mishkal, u.shmmida
-    FROM conversions c
-    JOIN units u ON c.mida = u.smlmida
-    WHERE c.mmitzrach = ?
-    ORDER BY u.shmmida
-    """
-    df = pd.read_sql_query(query, conn, params=(food_code,))
-    return df
+    return get_prefetched('units', food_code)
 
 def get_recipe_details(recipe_code):
     """Get components of a recipe"""
-    conn = get_connection()
-    query = """
-    SELECT r.*, p.shmmitzrach
-    FROM recipes r
-    LEFT JOIN products p ON r.mitzbsisi = p.Code
-    WHERE r.mmitzrach = ?
-    """
-    df = pd.read_sql_query(query, conn, params=(recipe_code,))
-    return df
+    return get_prefetched('recipe', recipe_code)
 
 def get_retention_options():
-    """Get list of retention cooking methods from database"""
-    conn = get_connection()
-    query = """
-    SELECT retention_code, retention_name, hebrew_name 
-    FROM retentions 
-    ORDER BY hebrew_name
-    """
-    try:
-        df = pd.read_sql_query(query, conn)
-        return df
-    except:
-        return pd.DataFrame()
+    """Retention cooking methods, ordered by Hebrew name (loaded with the retention matrix)"""
+    return get_retention_matrix(get_db_version()).options
+
+def cooked_nutrient_rows(food_codes, retention_codes):
+    """Per-100g FIELDS_MAPPING rows of foods after their cooking method (None for none).
 
-def get_retention_factors(retention_code):
-    """Get retention factors for a specific cooking method"""
-    conn = get_connection()
-    query = """
-    SELECT * FROM retentions WHERE retention_code = ?
+    Each (food, method) row is memoized in the query cache, so trying cooking
+    methods on the label page costs no database work; rows not cached yet are
+    computed together from the nutrient and retention matrices.
     """
-    try:
-        df = pd.read_sql_query(query, conn, params=(retention_code,))
-        return df.iloc[0] if len(df) > 0 else None
-    except:
-        return None
+    cache = get_query_cache()
+    db_version = get_db_version()
+    cache.ensure_version(db_version)
+    
+    pairs = list(zip(food_codes, retention_codes))
+    rows = {}
+    missing = []
+    for pair in dict.fromkeys(pairs):
+        row = cache.lookup(('cooked_vector', db_version, pair))
+        if row is MISSING:
+            missing.append(pair)
+        else:
+            rows[pair] = row
+    if missing:
+        codes, methods = zip(*missing)
+        raw = product_nutrient_rows(codes)
+        multipliers = get_retention_matrix(db_version).multipliers(methods)
+        for pair, raw_row, factors in zip(missing, raw, multipliers):
+            # The vector owns just its own values, so the cache's size estimate covers them
+            row = NutrientVector(raw_row).scale_fields(factors).values
+            row.flags.writeable = False
+            cache.store(('cooked_vector', db_version, pair), row)
+            rows[pair] = row
+    return np.array([rows[pair] for pair in pairs], dtype=np.float64).reshape(len(pairs), len(FIELDS_MAPPING))
+
+def product_sig_figs(code):
+    """Cached per-cell precision of one product's FIELDS_MAPPING values"""
+    _, sig_figs, _ = get_nutrient_matrix(get_db_version()).take_sig_figs([code])
+    return sig_figs[0]
+
+def display_all_nutrition(food_data, factor=1.0, sig_figs=None):
+    """Display all nutritional parameters.
 
-# Mapping from product nutrition fields to retention factor columns
-RETENTION_FIELD_MAPPING = {
-    'vitamin_b12': 'vitamin_b12',
-    'folate': 'folate',
-    'vitamin_b6': 'vitamin_b6',
-    'niacin': 'niacin',
-    'riboflavin': 'riboflavin',
-    'thiamin': 'thiamin',
-    'vitamin_c': 'vitamin_c',
-    'carotene': 'carotene',
-    'vitamin_a_re': 'vitamin_a_re',
-    'vitamin_a_iu': 'vitamin_a_iu',
-    'copper': 'copper',
-    'zinc': 'zinc',
-    'sodium': 'sodium',
-    'potassium': 'potassium',
-    'phosphorus': 'phosphorus',
-    'magnesium': 'magnesium',
-    'iron': 'iron',
-    'calcium': 'calcium'
-}
-
-def display_all_nutrition(food_data, factor=1.0):
-    """Display all nutritional parameters"""
+    sig_figs is the precision of each FIELDS_MAPPING value (product_sig_figs for
+    a catalog product); without it the precision is read off the values.
+    """
+    fields = list(FIELDS_MAPPING)
+    cells = [food_data.get(param) for param in fields]
+    if sig_figs is None:
+        sig_figs = count_sig_figs_array(cells)
+    # Every value is scaled and rounded in one call
+    scaled = dict(zip(fields, display_values(scale_with_sig_figs(to_float_array(cells), sig_figs, factor))))
     
     def get_val(param):
-        return calculate_with_sig_figs(food_data.get(param), factor)
+        return scaled[param]
 
     # Main macronutrients
     st.markdown("### מקרו-נוטריינטים")
@@ -422,8 +514,29 @@ def display_all_nutrition(food_data, factor=1.0):
             st.write(f"**כולין (מ\"ג):** {get_val('choline')}")
             st.write(f"**ביוטין (מק\"ג):** {get_val('biotin')}")
 
+# Fail fast on a database whose schema this code does not match (or migrate it first)
+schema_error = check_schema(read_db_version())
+if schema_error:
+    st.error(schema_error)
+    st.stop()
+
+# A rebuilt nutrition.db is picked up here, between reruns: the pool, indexes and caches
+# below are all keyed on this version, so the whole run reads from a single build
+st.session_state['db_version'] = read_db_version()
+
 # Sidebar for navigation
 page = st.sidebar.radio("בחר מצב:", ["חיפוש רגיל", "חיפוש מתקדם", "השוואת מוצרים", "מחשבון יומי", "מחשבון מתכונים", "עיצוב תווית"])
+st.sidebar.checkbox(
+    "השלמה אוטומטית בדפדפן",
+    value=True,
+    key="client_autocomplete",
+    help="סינון תוצאות החיפוש מתבצע בדפדפן ללא פנייה לשרת בכל הקשה"
+)
+with st.sidebar.expander("📊 מדדי מערכת"):
+    st.caption("מאגר חיבורים למסד הנתונים")
+    st.json(get_pool(get_db_version()).stats())
+    st.caption("מטמון שאילתות")
+    st.json(get_query_cache().stats())
 
 st.title("🍎 מחשבון תזונתי")
 st.markdown("---")
@@ -431,50 +544,40 @@ st.markdown("---")
 if page == "חיפוש רגיל":
     # Regular search section
     st.subheader("חיפוש מזון")
-    search_term = st.text_input("הזן שם מזון לחיפוש:", placeholder="לדוגמה: חלב, לחם, תפוח...")
+    selected_food_code, selected_food_name = food_picker(
+        "הזן שם מזון לחיפוש:", key="food_search", placeholder="לדוגמה: חלב, לחם, תפוח..."
+    )
 
-    if search_term:
-        results = search_foods(search_term)
+    if selected_food_code is not None:
+        food_data = get_food_details(selected_food_code)
         
-        if len(results) > 0:
-            st.success(f"נמצאו {len(results)} תוצאות")
+        if food_data is not None:
+            st.markdown("---")
+            st.subheader(f"נבחר: {selected_food_name}")
             
-            food_options = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
-            selected_food_name = st.selectbox("בחר מזון:", options=list(food_options.keys()))
+            units_df = get_available_units(selected_food_code)
             
-            if selected_food_name:
-                selected_food_code = food_options[selected_food_name]
-                food_data = get_food_details(selected_food_code)
+            if len(units_df) > 0:
+                col1, col2 = st.columns(2)
                 
-                if food_data is not None:
-                    st.markdown("---")
-                    st.subheader(f"נבחר: {selected_food_name}")
+                with col1:
+                    amount = st.number_input("כמות:", min_value=0.1, max_value=10000.0, value=1.0, step=0.1)
+                
+                with col2:
+                    unit_options = {row['shmmida']: (row['mida'], row['mishkal']) for _, row in units_df.iterrows()}
+                    selected_unit_name = st.selectbox("יחידת מידה:", options=list(unit_options.keys()))
+                
+                if selected_unit_name:
+                    unit_id, unit_weight = unit_options[selected_unit_name]
+                    factor = (amount * unit_weight) / 100
                     
-                    units_df = get_available_units(selected_food_code)
+                    st.markdown("---")
+                    st.info(f"**{amount} {selected_unit_name}** = **{amount * unit_weight:.1f} גרם**")
                     
-                    if len(units_df) > 0:
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            amount = st.number_input("כמות:", min_value=0.1, max_value=10000.0, value=1.0, step=0.1)
-                        
-                        with col2:
-                            unit_options = {row['shmmida']: (row['mida'], row['mishkal']) for _, row in units_df.iterrows()}
-                            selected_unit_name = st.selectbox("יחידת מידה:", options=list(unit_options.keys()))
-                        
-                        if selected_unit_name:
-                            unit_id, unit_weight = unit_options[selected_unit_name]
-                            factor = (amount * unit_weight) / 100
-                            
-                            st.markdown("---")
-                            st.info(f"**{amount} {selected_unit_name}** = **{amount * unit_weight:.1f} גרם**")
-                            
-                            # Display all nutrition
-                            display_all_nutrition(food_data, factor)
-                    else:
-                        st.warning("אין יחידות מידה זמינות למזון זה")
-        else:
-            st.warning("לא נמצאו תוצאות. נסה חיפוש אחר.")
+                    # Display all nutrition
+                    display_all_nutrition(food_data, factor, sig_figs=product_sig_figs(selected_food_code))
+            else:
+                st.warning("אין יחידות מידה זמינות למזון זה")
     else:
         st.info("👆 התחל בחיפוש מזון כדי לראות ערכים תזונתיים")
 
@@ -592,7 +695,7 @@ elif page == "חיפוש מתקדם":
                 if food_data is not None:
                     st.markdown("---")
                     st.subheader(f"פרטים: {selected_food_name}")
-                    display_all_nutrition(food_data, factor=1.0)
+                    display_all_nutrition(food_data, factor=1.0, sig_figs=product_sig_figs(selected_food_code))
         else:
             st.warning("לא נמצאו תוצאות התואמות את התנאים")
 
@@ -606,30 +709,22 @@ elif page == "השוואת מוצרים":
 
     # Product Search Section
     with st.expander("🔍 הוסף מוצרים להשוואה", expanded=True):
-        search_term = st.text_input("חפש מוצר להוספה:", placeholder="לדוגמה: חלב, גבינה...")
-        
-        if search_term:
-            results = search_foods(search_term)
-            if len(results) > 0:
-                food_options = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
-                selected_food_to_add = st.selectbox("בחר מוצר:", options=[''] + list(food_options.keys()))
-                
-                if selected_food_to_add and selected_food_to_add != '':
-                    code = food_options[selected_food_to_add]
-                    
-                    # Check if already in list
-                    if any(item['code'] == code for item in st.session_state.comparison_list):
-                        st.warning("המוצר כבר נמצא ברשימת ההשוואה")
-                    else:
-                        if st.button("הוסף להשוואה"):
-                            st.session_state.comparison_list.append({
-                                'name': selected_food_to_add,
-                                'code': code
-                            })
-                            st.success(f"נוסף: {selected_food_to_add}")
-                            st.rerun()
+        code, selected_food_to_add = food_picker(
+            "חפש מוצר להוספה:", key="compare_search", placeholder="לדוגמה: חלב, גבינה..."
+        )
+
+        if code is not None:
+            # Check if already in list
+            if any(item['code'] == code for item in st.session_state.comparison_list):
+                st.warning("המוצר כבר נמצא ברשימת ההשוואה")
             else:
-                st.warning("לא נמצאו תוצאות")
+                if st.button("הוסף להשוואה"):
+                    st.session_state.comparison_list.append({
+                        'name': selected_food_to_add,
+                        'code': code
+                    })
+                    st.success(f"נוסף: {selected_food_to_add}")
+                    st.rerun()
 
     # Selected Products List
     if st.session_state.comparison_list:
@@ -699,19 +794,17 @@ elif page == "השוואת מוצרים":
             
             # First pass: collect data
             products_data = []
-            for item in st.session_state.comparison_list:
-                food_details = get_food_details(item['code'])
-                if food_details is not None:
-                    product_values = {}
-                    product_values['name'] = item['name']
-                    
-                    # Calculate factor based on custom amount (default data is per 100g)
-                    factor = comparison_amount / 100.0
-                    
-                    for param in selected_params:
-                        val = food_details.get(param)
-                        product_values[param] = calculate_with_sig_figs(val, factor)
-                    
+            compared_values, compared_sig_figs, found = get_nutrient_matrix(get_db_version()).take_sig_figs(
+                [item['code'] for item in st.session_state.comparison_list], selected_params
+            )
+            # Calculate factor based on custom amount (default data is per 100g);
+            # the whole products × params table is scaled and rounded in one call
+            factor = comparison_amount / 100.0
+            compared = scale_with_sig_figs(compared_values, compared_sig_figs, factor)
+            for item, row, is_found in zip(st.session_state.comparison_list, compared, found):
+                if is_found:
+                    product_values = {'name': item['name']}
+                    product_values.update(zip(selected_params, display_values(row)))
                     products_data.append(product_values)
             
             # Sort data if requested
@@ -745,55 +838,45 @@ elif page == "מחשבון יומי":
     col1, col2 = st.columns([3, 1])
     
     with col1:
-        search_term = st.text_input("חפש מוצר להוספה:", key="daily_search")
+        selected_id, selected_product_name = food_picker("חפש מוצר להוספה:", key="daily_search")
     
-    if search_term:
-        results = search_foods(search_term)
-        if len(results) > 0:
-            product_options = {f"{row['shmmitzrach']}": row['Code'] for _, row in results.iterrows()}
-            selected_product_name = st.selectbox("בחר מוצר:", list(product_options.keys()), key="daily_select")
+    if selected_id is not None:
+        # Fetch available units
+        units_df = get_available_units(selected_id)
+        
+        col_qty, col_unit, col_add = st.columns([1, 1, 1])
+        
+        with col_qty:
+            amount = st.number_input("כמות:", min_value=0.1, value=1.0, step=0.1, key="daily_qty")
+        
+        with col_unit:
+            # Default unit is grams (100g usually, but here we treat 'grams' as a unit where 1 unit = 1g if we want, 
+            # but typically the DB has units. If no units, we fallback to grams input directly?
+            # The user wants to choose units.
             
-            if selected_product_name:
-                selected_id = product_options[selected_product_name]
-                
-                # Fetch available units
-                units_df = get_available_units(selected_id)
-                
-                col_qty, col_unit, col_add = st.columns([1, 1, 1])
-                
-                with col_qty:
-                    amount = st.number_input("כמות:", min_value=0.1, value=1.0, step=0.1, key="daily_qty")
-                
-                with col_unit:
-                    # Default unit is grams (100g usually, but here we treat 'grams' as a unit where 1 unit = 1g if we want, 
-                    # but typically the DB has units. If no units, we fallback to grams input directly?
-                    # The user wants to choose units.
-                    
-                    unit_options = {'גרם': 1.0} # Default
-                    if not units_df.empty:
-                        for _, row in units_df.iterrows():
-                            unit_options[row['shmmida']] = row['mishkal']
-                    
-                    selected_unit = st.selectbox("יחידה:", list(unit_options.keys()), key="daily_unit")
+            unit_options = {'גרם': 1.0} # Default
+            if not units_df.empty:
+                for _, row in units_df.iterrows():
+                    unit_options[row['shmmida']] = row['mishkal']
+            
+            selected_unit = st.selectbox("יחידה:", list(unit_options.keys()), key="daily_unit")
+        
+        with col_add:
+            st.write("") # Spacer
+            st.write("") # Spacer
+            if st.button("הוסף לרשימה", key="daily_add_btn"):
+                unit_weight = unit_options[selected_unit]
+                quantity_grams = amount * unit_weight
                 
-                with col_add:
-                    st.write("") # Spacer
-                    st.write("") # Spacer
-                    if st.button("הוסף לרשימה", key="daily_add_btn"):
-                        unit_weight = unit_options[selected_unit]
-                        quantity_grams = amount * unit_weight
-                        
-                        st.session_state.daily_list.append({
-                            'id': selected_id,
-                            'name': selected_product_name,
-                            'quantity': quantity_grams,
-                            'display_unit': selected_unit,
-                            'display_amount': amount
-                        })
-                        st.success(f"הוסף: {selected_product_name} ({amount} {selected_unit})")
-                        st.rerun()
-        else:
-            st.warning("לא נמצאו מוצרים")
+                st.session_state.daily_list.append({
+                    'id': selected_id,
+                    'name': selected_product_name,
+                    'quantity': quantity_grams,
+                    'display_unit': selected_unit,
+                    'display_amount': amount
+                })
+                st.success(f"הוסף: {selected_product_name} ({amount} {selected_unit})")
+                st.rerun()
 
     st.divider()
 
@@ -852,17 +935,14 @@ elif page == "מחשבון יומי":
 
         if selected_params:
             # Calculate totals
-            totals = {param: 0.0 for param in selected_params}
-            
-            for item in st.session_state.daily_list:
-                food_data = get_food_details(item['id'])
-                if food_data is not None:
-                    factor = item['quantity'] / 100.0
-                    for param in selected_params:
-                        val = food_data.get(param)
-                        # Calculate contribution with sig figs
-                        contribution = calculate_with_sig_figs(val, factor)
-                        totals[param] += contribution
+            # Only the selected nutrients are sliced out of the snapshot
+            daily_values, daily_sig_figs, found = get_nutrient_matrix(get_db_version()).take_sig_figs(
+                [item['id'] for item in st.session_state.daily_list], selected_params
+            )
+            # Contribution of every item to every nutrient with sig figs, one factor per item
+            factors = np.array([item['quantity'] / 100.0 for item in st.session_state.daily_list], dtype=np.float64)
+            contributions = scale_with_sig_figs(daily_values[found], daily_sig_figs[found], factors[found][:, None])
+            totals = dict(zip(selected_params, contributions.sum(axis=0).tolist()))
             
             # Display results
             # Create a nice display for the results
@@ -882,15 +962,7 @@ elif page == "מחשבון מתכונים":
     
     if search_term:
         # We search in products, but filter for those that HAVE a recipe
-        conn = get_connection()
-        query = """
-        SELECT DISTINCT p.Code, p.shmmitzrach 
-        FROM products p
-        JOIN recipes r ON p.Code = r.mmitzrach
-        WHERE p.shmmitzrach LIKE ?
-        LIMIT 50
-        """
-        results = pd.read_sql_query(query, conn, params=(f'%{search_term}%',))
+        results, _ = paged_search(search_recipes, search_term, key="recipe_search")
         
         if not results.empty:
             recipe_options = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
@@ -941,43 +1013,18 @@ elif page == "מחשבון מתכונים":
                     
                     if st.button("🧮 חשב ערכים תזונתיים ל-100 גרם (מוצר מוגמר)"):
                          # 1. Sum raw nutrients
-                        raw_totals = {}
-                        
-                        # We need to iterate over all ingredients and sum their nutrients
-                        # This requires fetching food details for each ingredient code
-                        # We can do this efficiently?
+                        # Ingredient rows are sliced straight out of the memory-mapped nutrient matrix
+                        all_params = list(FIELDS_MAPPING.keys())
+                        matrix = get_nutrient_matrix(get_db_version())
+                        values, missing, found = matrix.take(details['mitzbsisi'].tolist(), all_params)
                         
-                        valid_ingredients = []
-                        for _, row in details.iterrows():
-                             ing_code = row['mitzbsisi']
-                             ing_weight = row['mishkal']
-                             
-                             food_data = get_food_details(ing_code)
-                             if food_data is not None:
-                                 valid_ingredients.append({'data': food_data, 'weight': ing_weight})
-                        
-                        if valid_ingredients:
-                            # Use first ingredient keys as schema
-                            all_params = list(FIELDS_MAPPING.keys())
-                            for param in all_params:
-                                total_val = 0
-                                for item in valid_ingredients:
-                                    val = item['data'].get(param)
-                                    if val is not None:
-                                         try:
-                                             val_float = float(val)
-                                             total_val += val_float * (item['weight'] / 100.0) # Nutrient amount in this ingredient
-                                         except:
-                                             pass
-                                raw_totals[param] = total_val
-                                
+                        if found.any():
+                            # Nutrient amount of each ingredient (missing values count as 0), summed per nutrient
+                            weights = pd.to_numeric(details['mishkal'], errors='coerce').to_numpy(dtype=np.float64)[found]
+                            raw_totals = NutrientVector.weighted_sum(np.where(missing[found], 0.0, values[found]), weights / 100.0)
+                            
                             # 2. Divide by Final Weight and multiply by 100 to get per 100g
-                            final_100g_values = {}
-                            for param, total_val in raw_totals.items():
-                                if final_weight > 0:
-                                    final_100g_values[param] = (total_val / final_weight) * 100.0
-                                else:
-                                    final_100g_values[param] = 0
+                            final_100g_values = raw_totals.normalize(final_weight).to_dict()
                                     
                             st.write("#### ערכים תזונתיים ל-100 גרם (מוצר מוגמר)")
                             display_all_nutrition(final_100g_values, factor=1.0) # Factor 1.0 because values are already per 100g
@@ -1044,25 +1091,13 @@ elif page == "עיצוב תווית":
     label_data = {
         'name': '',
         'ingredients': '',
-        'nutrition': {}
+        'nutrition': NutrientVector().to_dict()  # Defaults
     }
     
-    # Defaults
-    for k in FIELDS_MAPPING.keys():
-        label_data['nutrition'][k] = 0.0
-    
     if source_type == "מתכון קיים":
         search_recipe = st.text_input("חפש מתכון:", placeholder="שניצל...")
         if search_recipe:
-            conn = get_connection()
-            query = """
-            SELECT DISTINCT p.Code, p.shmmitzrach 
-            FROM products p
-            JOIN recipes r ON p.Code = r.mmitzrach
-            WHERE p.shmmitzrach LIKE ?
-            LIMIT 20
-            """
-            results = pd.read_sql_query(query, conn, params=(f'%{search_recipe}%',))
+            results, _ = paged_search(search_recipes, search_recipe, key="label_recipe_search")
             
             if not results.empty:
                 recipe_opts = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
@@ -1082,10 +1117,8 @@ elif page == "עיצוב תווית":
                         label_data['ingredients'] = ", ".join(ing_list)
                         
                         # Get nutrition
-                        prod_details = get_food_details(code)
-                        if prod_details is not None:
-                             for key in FIELDS_MAPPING.keys():
-                                 label_data['nutrition'][key] = prod_details.get(key, 0)
+                        if code in get_nutrient_matrix(get_db_version()):
+                             label_data['nutrition'] = NutrientVector(product_nutrient_rows([code])[0]).to_dict()
     
     elif source_type == "(מומלץ) צור מתכון ממוצרים במאגר":
         st.caption("הרכב מוצר ממספר רכיבים. המערכת תחשב את הערכים הסופיים ותסדר את רשימת הרכיבים.")
@@ -1098,20 +1131,11 @@ elif page == "עיצוב תווית":
         col_search, col_qty, col_unit, col_add = st.columns([3, 1, 1, 1])
         
         with col_search:
-            search_prod = st.text_input("חפש רכיב להוספה:", placeholder="קמח, סוכר, ביצים...", key="label_search_prod")
-            
-        selected_code = None
-        selected_name = None
-        
-        if search_prod:
-            results = search_foods(search_prod)
-            if not results.empty:
-                prod_opts = {row['shmmitzrach']: row['Code'] for _, row in results.iterrows()}
-                selected_name = st.selectbox("בחר רכיב:", list(prod_opts.keys()), key="label_sel_prod")
-                if selected_name:
-                    selected_code = prod_opts[selected_name]
+            selected_code, selected_name = food_picker(
+                "חפש רכיב להוספה:", key="label_search_prod", placeholder="קמח, סוכר, ביצים..."
+            )
 
-        if selected_code:
+        if selected_code is not None:
             units_df = get_available_units(selected_code)
             
             with col_qty:
@@ -1195,48 +1219,42 @@ elif page == "עיצוב תווית":
                         st.markdown("---")
                         st.markdown(f"**⚙️ הגדרת ספיחת שמן עבור: {item['name']}**")
                         
-                        oil_search = st.text_input("חפש מוצר (שמן):", placeholder="שמן סויה, שמן זית...", key=f"oil_search_{i}")
+                        selected_oil_code, selected_oil_name = food_picker(
+                            "חפש מוצר (שמן):", key=f"oil_search_{i}", placeholder="שמן סויה, שמן זית..."
+                        )
                         
-                        if oil_search:
-                            oil_results = search_foods(oil_search)
-                            if not oil_results.empty:
-                                oil_opts = {row['shmmitzrach']: row['Code'] for _, row in oil_results.iterrows()}
-                                selected_oil_name = st.selectbox("בחר שמן:", list(oil_opts.keys()), key=f"oil_select_{i}")
-                                
-                                if selected_oil_name:
-                                    selected_oil_code = oil_opts[selected_oil_name]
-                                    
-                                    # Get current percentage if exists
-                                    current_pct = oil_ret['percentage'] if oil_ret else 7.0
-                                    
-                                    oil_pct = st.number_input(
-                                        "אחוז ספיחת שמן (%):",
-                                        min_value=0.0,
-                                        max_value=100.0,
-                                        value=current_pct,
-                                        step=0.5,
-                                        key=f"oil_pct_{i}"
-                                    )
-                                    
-                                    col_save, col_clear, col_cancel = st.columns(3)
-                                    with col_save:
-                                        if st.button("💾 שמור", key=f"oil_save_{i}"):
-                                            st.session_state.label_ingredients[i]['oil_retention'] = {
-                                                'oil_code': selected_oil_code,
-                                                'oil_name': selected_oil_name,
-                                                'percentage': oil_pct
-                                            }
-                                            st.session_state[f'oil_expand_{i}'] = False
-                                            st.rerun()
-                                    with col_clear:
-                                        if st.button("🗑️ נקה", key=f"oil_clear_{i}"):
-                                            st.session_state.label_ingredients[i]['oil_retention'] = None
-                                            st.session_state[f'oil_expand_{i}'] = False
-                                            st.rerun()
-                                    with col_cancel:
-                                        if st.button("❌ ביטול", key=f"oil_cancel_{i}"):
-                                            st.session_state[f'oil_expand_{i}'] = False
-                                            st.rerun()
+                        if selected_oil_code is not None:
+                            # Get current percentage if exists
+                            current_pct = oil_ret['percentage'] if oil_ret else 7.0
+                            
+                            oil_pct = st.number_input(
+                                "אחוז ספיחת שמן (%):",
+                                min_value=0.0,
+                                max_value=100.0,
+                                value=current_pct,
+                                step=0.5,
+                                key=f"oil_pct_{i}"
+                            )
+                            
+                            col_save, col_clear, col_cancel = st.columns(3)
+                            with col_save:
+                                if st.button("💾 שמור", key=f"oil_save_{i}"):
+                                    st.session_state.label_ingredients[i]['oil_retention'] = {
+                                        'oil_code': selected_oil_code,
+                                        'oil_name': selected_oil_name,
+                                        'percentage': oil_pct
+                                    }
+                                    st.session_state[f'oil_expand_{i}'] = False
+                                    st.rerun()
+                            with col_clear:
+                                if st.button("🗑️ נקה", key=f"oil_clear_{i}"):
+                                    st.session_state.label_ingredients[i]['oil_retention'] = None
+                                    st.session_state[f'oil_expand_{i}'] = False
+                                    st.rerun()
+                            with col_cancel:
+                                if st.button("❌ ביטול", key=f"oil_cancel_{i}"):
+                                    st.session_state[f'oil_expand_{i}'] = False
+                                    st.rerun()
                         
                         st.markdown("---")
                 
@@ -1408,64 +1426,29 @@ elif page == "עיצוב תווית":
                     total_weight_with_oil += item['weight'] * oil_ret['percentage'] / 100.0
             
             if total_weight_with_oil > 0:
-                mix_nutrition = {k: 0.0 for k in FIELDS_MAPPING.keys()}
-                
-                for item in st.session_state.label_ingredients:
-                    prod_details = get_food_details(item['code'])
-                    if prod_details is not None:
-                        # Convert nutrition (per 100g) to actual amount in item
-                        item_factor = item['weight'] / 100.0
-                        
-                        # Apply nutrient loss if set (BEFORE oil retention)
-                        nutrient_loss = item.get('nutrient_loss')
-                        loss_factor = 1.0 - (nutrient_loss / 100.0) if nutrient_loss else 1.0
-                        
-                        # Get retention factors if a retention code is set
-                        retention_factors = None
-                        retention_info = item.get('retention_code')
-                        if retention_info:
-                            retention_factors = get_retention_factors(retention_info['code'])
-                        
-                        for k in FIELDS_MAPPING.keys():
-                            val = prod_details.get(k, 0)
-                            try:
-                                val = float(val)
-                            except:
-                                val = 0
-                            
-                            # Apply retention factor if applicable
-                            retention_multiplier = 1.0
-                            if retention_factors is not None and k in RETENTION_FIELD_MAPPING:
-                                retention_col = RETENTION_FIELD_MAPPING[k]
-                                try:
-                                    retention_pct = float(retention_factors.get(retention_col, 100))
-                                    retention_multiplier = retention_pct / 100.0
-                                except:
-                                    retention_multiplier = 1.0
-                            
-                            # Apply nutrient loss and retention factor to the product's values
-                            mix_nutrition[k] += val * item_factor * loss_factor * retention_multiplier
-                    
-                    # Add oil retention nutrition if set
-                    oil_ret = item.get('oil_retention')
-                    if oil_ret:
-                        oil_details = get_food_details(oil_ret['oil_code'])
-                        if oil_details is not None:
-                            # Oil weight = ingredient weight * percentage / 100
-                            oil_weight = item['weight'] * oil_ret['percentage'] / 100.0
-                            oil_factor = oil_weight / 100.0  # Convert to per-100g factor
-                            for k in FIELDS_MAPPING.keys():
-                                val = oil_details.get(k, 0)
-                                try:
-                                    val = float(val)
-                                except:
-                                    val = 0
-                                mix_nutrition[k] += val * oil_factor
+                # One row per ingredient: its nutrients, the oil it absorbs and its cooking retention
+                ingredients = st.session_state.label_ingredients
+                oils = [item.get('oil_retention') for item in ingredients]
+                values = cooked_nutrient_rows(
+                    [item['code'] for item in ingredients],
+                    [item['retention_code']['code'] if item.get('retention_code') else None for item in ingredients]
+                )
+                oil_values = product_nutrient_rows([oil['oil_code'] if oil else None for oil in oils])
+                weights = np.array([item['weight'] for item in ingredients], dtype=np.float64)
+                # Oil weight = ingredient weight * percentage / 100
+                oil_weights = np.array(
+                    [item['weight'] * oil['percentage'] / 100.0 if oil else 0.0 for item, oil in zip(ingredients, oils)],
+                    dtype=np.float64
+                )
+                # Nutrient loss is applied BEFORE oil retention
+                loss_factors = np.array(
+                    [1.0 - (item['nutrient_loss'] / 100.0) if item.get('nutrient_loss') else 1.0 for item in ingredients],
+                    dtype=np.float64
+                )
                 
                 # Normalize to 100g of final mix (including oil)
-                final_factor = 100.0 / total_weight_with_oil
-                for k in FIELDS_MAPPING.keys():
-                    label_data['nutrition'][k] = mix_nutrition[k] * final_factor
+                mix_nutrition = mix_per_100g(values, weights, loss_factors, oil_values, oil_weights, total_weight_with_oil)
+                label_data['nutrition'] = mix_nutrition.to_dict()
 
     # --- Step 2: Refine Data ---
     st.markdown("---")
@@ -1539,14 +1522,10 @@ elif page == "עיצוב תווית":
         st.info(f"⚠️ עם איבוד נוזלים של {fluid_loss_pct:.1f}%, כל הערכים מופחתים ב-{fluid_loss_pct:.1f}%")
     
     # Get all nutrition values with adjustments
-    def get_adjusted_val(field):
-        val = edited_nutrition.get(field, label_data.get('nutrition', {}).get(field, 0))
-        if val is None:
-            val = 0
-        try:
-            return float(val) * combined_factor
-        except:
-            return 0
+    def get_adjusted_values(fields):
+        """Every field's value times combined_factor in one call (missing or invalid values count as 0)"""
+        nutrition = NutrientVector.from_dict({**label_data.get('nutrition', {}), **edited_nutrition})
+        return (nutrition * combined_factor).to_dict(fields)
     
     # Define nutrient categories
     nutrient_categories = {
@@ -1666,12 +1645,15 @@ elif page == "עיצוב תווית":
     
     html_content = [table_css, '<div class="nutrient-table-container">']
     
+    grid_fields = [field for nutrients in nutrient_categories.values() for field, _, _ in nutrients]
+    adjusted = get_adjusted_values(grid_fields)
+    
     for category_name, nutrients in nutrient_categories.items():
         html_content.append(f'<div class="nutrient-category">{category_name}</div>')
         html_content.append('<div class="nutrient-grid">')
         
         for field, display_name, unit in nutrients:
-            val = get_adjusted_val(field)
+            val = adjusted[field]
             # Format value based on magnitude
             if val >= 100:
                 formatted_val = f"{val:.0f}"
@@ -0,0 +1,190 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from nutrition_db import read_db_version
+
+# Read tuning applied to every pooled connection
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 16 * 1024
+TEMP_STORE = 'MEMORY'
+
+
+class ConnectionPool:
+    """Read-only SQLite connections shared by all sessions.
+
+    Each connection is used by one thread at a time: `connection()` checks one
+    out and returns it when the block ends. A thread that already holds a
+    connection gets the same one back, so nested accessors do not deadlock
+    the pool. Connections are opened with `immutable=1`, so a pool must only
+    be used for one build of the database file - a rebuilt file needs a new
+    pool.
+    """
+
+    def __init__(self, path, max_connections=8, timeout=10.0):
+        self.path = os.path.abspath(path)
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._waiting = 0
+        self._metrics = {
+            'opened': 0,
+            'in_use': 0,
+            'max_in_use': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+        }
+
+    def _open(self):
+        uri = f"file:{quote(self.path)}?mode=ro&immutable=1"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA temp_store = {TEMP_STORE}")
+        return conn
+
+    def _checkout(self):
+        # Idle connections go to threads already waiting before new arrivals
+        if not self._waiting:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+        with self._lock:
+            can_open = self._metrics['opened'] < self.max_connections
+            if can_open:
+                self._metrics['opened'] += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._metrics['opened'] -= 1
+                raise
+
+        # Every connection is busy: wait for one to come back
+        started = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._metrics['timeouts'] += 1
+            raise TimeoutError(f"No database connection became free within {self.timeout} seconds")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        with self._lock:
+            self._metrics['waits'] += 1
+            self._metrics['wait_seconds'] += time.perf_counter() - started
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(conn)
+                return
+            self._metrics['opened'] -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the current thread"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        if self._closed:
+            # A retired pool (its database build was replaced) still serves late
+            # callers, each on a connection of its own that is closed after use
+            conn = self._open()
+            with self._lock:
+                self._metrics['opened'] += 1
+        else:
+            conn = self._checkout()
+        with self._lock:
+            self._metrics['checkouts'] += 1
+            self._metrics['in_use'] += 1
+            self._metrics['max_in_use'] = max(self._metrics['max_in_use'], self._metrics['in_use'])
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            with self._lock:
+                self._metrics['in_use'] -= 1
+            self._release(conn)
+
+    def close(self):
+        """Close idle connections now and busy ones as they are returned"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._metrics['opened'] -= 1
+
+    def stats(self):
+        """Pool usage counters, for diagnostics"""
+        with self._lock:
+            stats = dict(self._metrics)
+        stats['idle'] = self._idle.qsize()
+        stats['max_connections'] = self.max_connections
+        return stats
+
+
+class VersionedPool:
+    """The ConnectionPool of the newest build of one database file.
+
+    `pool(db_version)` swaps in a new pool only for the build now on disk.
+    A caller still pinned to a build that was replaced gets the current pool
+    instead of evicting it: a retired pool would open the same path, which
+    now holds the new build, so nothing is lost and sessions on different
+    builds never take turns recreating the pool.
+    """
+
+    def __init__(self, path, max_connections=8, timeout=10.0):
+        self.path = os.path.abspath(path)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._version = None
+        self._pool = None
+
+    def pool(self, db_version):
+        """Pool for a database build; the current pool when db_version is no longer on disk"""
+        with self._lock:
+            if self._pool is not None and db_version == self._version:
+                return self._pool
+            if self._pool is not None and db_version != read_db_version(self.path):
+                return self._pool
+            retired = self._pool
+            self._pool = ConnectionPool(self.path, max_connections=self.max_connections, timeout=self.timeout)
+            self._version = db_version
+            pool = self._pool
+        if retired is not None:
+            retired.close()
+        return pool
+
+    def close(self):
+        with self._lock:
+            pool, self._pool, self._version = self._pool, None, None
+        if pool is not None:
+            pool.close()
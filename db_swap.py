@@ -0,0 +1,85 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from urllib.parse import quote
+
+
+def shadow_path(db_path):
+    """Private file a new build of db_path is written to before it is published"""
+    return f"{db_path}.{os.getpid()}.building"
+
+
+def remove_database_files(path):
+    """Delete a database file together with any journal SQLite left next to it"""
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def validate_database(path, required_tables):
+    """Check a built database before it goes live: integrity, and every required table present and non-empty"""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if result != 'ok':
+            raise ValueError(f"Integrity check failed for {path}: {result}")
+        for table in required_tables:
+            try:
+                count = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            except sqlite3.OperationalError:
+                raise ValueError(f"Table {table} is missing from {path}")
+            if count == 0:
+                raise ValueError(f"Table {table} is empty in {path}")
+    finally:
+        conn.close()
+
+
+def publish_database(built_path, db_path):
+    """Atomically move a finished build over db_path.
+
+    Readers that already have the old file open keep reading it until they
+    close it; every connection opened afterwards sees the new build.
+    """
+    with open(built_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(built_path, db_path)
+    if os.name == 'posix':
+        dir_fd = os.open(os.path.dirname(os.path.abspath(db_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+@contextmanager
+def shadow_build(db_path, required_tables, copy_existing=False):
+    """Yield a connection to a shadow copy of db_path and publish it once the block succeeds.
+
+    With copy_existing the shadow starts as a copy of the live database (for
+    scripts that change only some tables); otherwise it starts empty. The live
+    file is never written to, and a failed or invalid build is discarded.
+    """
+    shadow = shadow_path(db_path)
+    remove_database_files(shadow)
+
+    if copy_existing:
+        source = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+        target = sqlite3.connect(shadow)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    conn = sqlite3.connect(shadow)
+    try:
+        yield conn
+        conn.commit()
+        conn.close()
+        validate_database(shadow, required_tables)
+    except BaseException:
+        conn.close()
+        remove_database_files(shadow)
+        raise
+
+    publish_database(shadow, db_path)
@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import pandas as pd
+
+from db_swap import shadow_build
+from hebrew_search import search_index_exists, update_search_index
+from nutrient_matrix import export_nutrient_matrix
+from sig_figs import write_source_precision
+
+# Natural key of every table a Ministry of Health release updates
+TABLE_KEYS = {
+    'products': ('Code',),
+    'recipes': ('mmitzrach', 'mitzbsisi'),
+    'conversions': ('mmitzrach', 'mida'),
+    'retentions': ('retention_code',),
+}
+
+# Column holding the product code a row belongs to (used to report changed products)
+PRODUCT_CODE_COLUMN = {
+    'products': 'Code',
+    'recipes': 'mmitzrach',
+    'conversions': 'mmitzrach',
+}
+
+CHANGE_LOG_TABLE = 'change_log'
+
+
+def plain_value(value):
+    """SQLite-ready Python value: NaN becomes None and numpy scalars become Python scalars"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+        if isinstance(value, float) and value != value:
+            return None
+    return value
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def compute_delta(conn, table, new_df):
+    """Compare a fresh export with the table; returns (columns, inserted, updated, deleted).
+
+    inserted and updated are lists of full rows in table column order, deleted
+    is a list of key tuples. The export must have the same columns as the
+    table - a changed layout needs a full rebuild with setup_db.py.
+    """
+    key_columns = TABLE_KEYS[table]
+    columns = table_columns(conn, table)
+    if not columns:
+        raise ValueError(f"Table {table} does not exist; run a full import first")
+    if set(new_df.columns) != set(columns):
+        added = sorted(set(new_df.columns) - set(columns))
+        removed = sorted(set(columns) - set(new_df.columns))
+        raise ValueError(f"Columns of {table} changed (added {added}, removed {removed}); run setup_db.py instead")
+
+    key_index = [columns.index(column) for column in key_columns]
+    def key_of(row):
+        return tuple(row[i] for i in key_index)
+
+    quoted = ", ".join(f'"{column}"' for column in columns)
+    current = {key_of(row): row for row in conn.execute(f'SELECT {quoted} FROM "{table}"')}
+
+    incoming = {}
+    for row in new_df[columns].itertuples(index=False, name=None):
+        row = tuple(plain_value(value) for value in row)
+        key = key_of(row)
+        if key in incoming:
+            raise ValueError(f"Duplicate key {key} for {table} in the new export")
+        incoming[key] = row
+
+    inserted = [row for key, row in incoming.items() if key not in current]
+    updated = [row for key, row in incoming.items() if key in current and current[key] != row]
+    deleted = [key for key in current if key not in incoming]
+    return columns, inserted, updated, deleted
+
+
+def ensure_change_log(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+            batch_id INTEGER NOT NULL,
+            applied_at TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            change TEXT NOT NULL,
+            product_code INTEGER
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_change_log_batch ON {CHANGE_LOG_TABLE}(batch_id)")
+
+
+def apply_delta(conn, table, columns, inserted, updated, deleted, batch_id, applied_at):
+    """Write one table's changes and their change-log rows; returns the product codes touched"""
+    key_columns = TABLE_KEYS[table]
+    key_where = " AND ".join(f'"{column}" = ?' for column in key_columns)
+    key_index = [columns.index(column) for column in key_columns]
+    code_column = PRODUCT_CODE_COLUMN.get(table)
+
+    conn.executemany(f'DELETE FROM "{table}" WHERE {key_where}', deleted)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    conn.executemany(
+        f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join("?" * len(columns))})',
+        inserted
+    )
+    set_clause = ", ".join(f'"{column}" = ?' for column in columns)
+    conn.executemany(
+        f'UPDATE "{table}" SET {set_clause} WHERE {key_where}',
+        [row + tuple(row[i] for i in key_index) for row in updated]
+    )
+
+    log_rows = []
+    changed_codes = set()
+    for change, keys in (
+        ('insert', [tuple(row[i] for i in key_index) for row in inserted]),
+        ('update', [tuple(row[i] for i in key_index) for row in updated]),
+        ('delete', deleted),
+    ):
+        for key in keys:
+            code = key[key_columns.index(code_column)] if code_column else None
+            if code is not None:
+                changed_codes.add(code)
+            log_rows.append((batch_id, applied_at, table, json.dumps(list(key)), change, code))
+    conn.executemany(
+        f"INSERT INTO {CHANGE_LOG_TABLE} (batch_id, applied_at, table_name, row_key, change, product_code) "
+        f"VALUES (?, ?, ?, ?, ?, ?)",
+        log_rows
+    )
+    return changed_codes
+
+
+def changed_codes_since(conn, batch_id=0):
+    """Product and retention codes changed by import batches after batch_id, for selective cache invalidation"""
+    products = {
+        row[0] for row in conn.execute(
+            f"SELECT DISTINCT product_code FROM {CHANGE_LOG_TABLE} WHERE batch_id > ? AND product_code IS NOT NULL",
+            (batch_id,)
+        )
+    }
+    retentions = {
+        json.loads(row[0])[0] for row in conn.execute(
+            f"SELECT DISTINCT row_key FROM {CHANGE_LOG_TABLE} WHERE batch_id > ? AND table_name = 'retentions'",
+            (batch_id,)
+        )
+    }
+    return {'products': products, 'retentions': retentions}
+
+
+def import_delta(sources, db_path='nutrition.db', dry_run=False, precision=None):
+    """Apply the changed rows of fresh exports to db_path.
+
+    `sources` maps a table name to a DataFrame of its full new export.
+    `precision` is the (fields, rows) source-precision sidecar of a new
+    products export (see setup_db.parse_source); it replaces the stored one.
+    All tables are updated in one transaction on a copy of the live database,
+    which is then validated and swapped in (see db_swap). Returns
+    {'batch_id', 'tables': {table: (inserted, updated, deleted)}, 'products', 'retentions'}.
+    """
+    started = time.perf_counter()
+    summary = {'batch_id': None, 'tables': {}, 'products': set(), 'retentions': set()}
+
+    if dry_run:
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+        try:
+            for table, new_df in sources.items():
+                _, inserted, updated, deleted = compute_delta(conn, table, new_df)
+                summary['tables'][table] = (len(inserted), len(updated), len(deleted))
+        finally:
+            conn.close()
+        return summary
+
+    with shadow_build(db_path, ['products'] + list(sources), copy_existing=True) as conn:
+        conn.execute("BEGIN")
+        ensure_change_log(conn)
+        batch_id = conn.execute(f"SELECT COALESCE(MAX(batch_id), 0) + 1 FROM {CHANGE_LOG_TABLE}").fetchone()[0]
+        applied_at = datetime.now().isoformat(timespec='seconds')
+        summary['batch_id'] = batch_id
+
+        for table, new_df in sources.items():
+            columns, inserted, updated, deleted = compute_delta(conn, table, new_df)
+            codes = apply_delta(conn, table, columns, inserted, updated, deleted, batch_id, applied_at)
+            summary['tables'][table] = (len(inserted), len(updated), len(deleted))
+            if table == 'retentions':
+                summary['retentions'] |= {key[0] for key in deleted}
+                summary['retentions'] |= {row[columns.index('retention_code')] for row in inserted + updated}
+            else:
+                summary['products'] |= codes
+
+            # Only renamed, added or removed products need their search entries rebuilt
+            if table == 'products' and search_index_exists(conn):
+                update_search_index(conn, codes)
+
+        # Rewritten whole: a number re-typed from "24" to "24.0" changes no stored value
+        if precision is not None:
+            write_source_precision(conn, *precision)
+
+    # The products × nutrients snapshot is per build, so it is rewritten after any change
+    export_nutrient_matrix(db_path)
+
+    summary['seconds'] = time.perf_counter() - started
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply only the changed rows of new Ministry of Health exports to nutrition.db")
+    parser.add_argument('--products', help="moh_mitzrachim export (CSV)")
+    parser.add_argument('--recipes', help="moh_matkonim export (CSV)")
+    parser.add_argument('--conversions', help="moh_yehidot_mida_lemitzrachim export (CSV)")
+    parser.add_argument('--retentions', help="retentions export")
+    parser.add_argument('--db', default='nutrition.db')
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+    args = parser.parse_args()
+
+    # Imported here: setup_db imports this module through migrations
+    from setup_db import parse_source
+
+    # Parsed exactly as a full build parses them, so unchanged rows compare equal
+    sources = {}
+    precision = None
+    for table in ('products', 'recipes', 'conversions', 'retentions'):
+        path = getattr(args, table)
+        if path:
+            parsed = parse_source(table, path)
+            sources[table] = pd.DataFrame(parsed.rows, columns=parsed.columns)
+            if parsed.precision is not None:
+                precision = (parsed.precision_fields, parsed.precision)
+    if not sources:
+        parser.error("Give at least one export to import")
+
+    summary = import_delta(sources, db_path=args.db, dry_run=args.dry_run, precision=precision)
+
+    print("\n=== Delta Import ===" + (" (dry run)" if args.dry_run else ""))
+    for table, (inserted, updated, deleted) in summary['tables'].items():
+        print(f"{table}: {inserted} inserted, {updated} updated, {deleted} deleted")
+    if not args.dry_run:
+        print(f"Batch {summary['batch_id']}: {len(summary['products'])} products and "
+              f"{len(summary['retentions'])} retention codes changed ({summary['seconds']:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+# Final letters are indexed as their regular forms so "חלב ע" matches "עם"
+FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+
+# Quotes, geresh and gershayim are dropped so ק"ג, ק״ג and קג all index the same
+IGNORED_CHARS = str.maketrans('', '', '"\'`׳״')
+
+# Single-letter prefixes (ו, ה, ב, כ, ל, מ, ש) that can be glued to a Hebrew word
+HEBREW_PREFIXES = 'והבכלמש'
+MAX_PREFIX_LETTERS = 3
+MIN_STEM_LENGTH = 2
+
+TOKEN_RE = re.compile(r'\w+')
+
+FTS_TABLE = 'products_fts'
+
+# Persistent FTS5 rank: hits on the name itself outweigh hits on prefix-stripped stems
+RANK_FUNCTION = 'bm25(10.0, 1.0)'
+
+# While at most this many products are still fuzzy candidates, later query
+# words only compute edit distances to words of those products
+FUZZY_CANDIDATE_LIMIT = 500
+
+
+def normalize_hebrew(text):
+    """Normalize text for searching: drop niqqud and quotes, map final letters, lowercase"""
+    if text is None:
+        return ''
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return text.translate(IGNORED_CHARS).translate(FINAL_LETTERS).lower()
+
+
+def tokenize(text):
+    """Split normalized text into search tokens"""
+    return TOKEN_RE.findall(normalize_hebrew(text))
+
+
+def prefix_stems(token):
+    """Return the token with up to MAX_PREFIX_LETTERS Hebrew prefix letters stripped"""
+    stems = []
+    stem = token
+    for _ in range(MAX_PREFIX_LETTERS):
+        if len(stem) - 1 < MIN_STEM_LENGTH or stem[0] not in HEBREW_PREFIXES:
+            break
+        stem = stem[1:]
+        stems.append(stem)
+    return stems
+
+
+def build_match_query(search_term):
+    """Build an FTS5 MATCH expression (every token as a prefix) or None if nothing to match"""
+    tokens = tokenize(search_term)
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def search_index_exists(conn):
+    """Check whether the FTS5 product-name index was built for this database"""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+    ).fetchone()
+    return row is not None
+
+
+def create_search_index(conn):
+    """Build the FTS5 index over product names (name tokens plus prefix-stripped stems)"""
+    conn.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+            name, stems,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+
+    rows = [search_index_row(code, name) for code, name in conn.execute("SELECT Code, shmmitzrach FROM products")]
+
+    conn.executemany(f"INSERT INTO {FTS_TABLE}(rowid, name, stems) VALUES (?, ?, ?)", rows)
+    conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', ?)", (RANK_FUNCTION,))
+    conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return len(rows)
+
+
+def search_index_row(code, name):
+    """(rowid, name, stems) row of the search index for one product"""
+    tokens = tokenize(name)
+    stems = [stem for token in tokens for stem in prefix_stems(token)]
+    return code, " ".join(tokens), " ".join(stems)
+
+
+def update_search_index(conn, codes):
+    """Re-index the names of the given products, dropping those that no longer exist"""
+    codes = list(codes)
+    conn.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = ?", [(code,) for code in codes])
+    rows = []
+    for code in codes:
+        found = conn.execute("SELECT shmmitzrach FROM products WHERE Code = ?", (code,)).fetchone()
+        if found is not None:
+            rows.append(search_index_row(code, found[0]))
+    conn.executemany(f"INSERT INTO {FTS_TABLE}(rowid, name, stems) VALUES (?, ?, ?)", rows)
+    return len(rows)
+
+
+def match_tier(match_name, phrase):
+    """Relevance tier of a normalized name: 0 exact, 1 prefix, 2 word start, 3 anything else"""
+    if match_name == phrase:
+        return 0
+    if match_name.startswith(phrase):
+        return 1
+    if f' {phrase}' in match_name:
+        return 2
+    return 3
+
+
+def matches_all_tokens(match_name, stems, tokens):
+    """Mirror of the FTS5 prefix query: every token prefixes some indexed name word or stem"""
+    words = match_name.split() + stems.split()
+    return all(any(word.startswith(token) for word in words) for token in tokens)
+
+
+class IncrementalSearch:
+    """Per-session search state that narrows the last candidate set in memory when the query is extended.
+
+    The candidates belong to the database build they were fetched from; once
+    another build is live they are dropped instead of narrowed.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the remembered candidates"""
+        self.phrase = None
+        self.candidates = None
+        self.complete = False
+        self.db_version = None
+
+    def can_narrow(self, search_term, db_version):
+        """An extended query can only match a subset of a complete previous candidate set of the same build"""
+        if db_version != self.db_version:
+            self.reset()
+            return False
+        if not self.complete or self.phrase is None:
+            return False
+        return " ".join(tokenize(search_term)).startswith(self.phrase)
+
+    def narrow(self, search_term):
+        """Filter and re-rank the remembered candidates for an extended query"""
+        tokens = tokenize(search_term)
+        phrase = " ".join(tokens)
+        candidates = self.candidates
+        keep = [
+            matches_all_tokens(name, stems, tokens)
+            for name, stems in zip(candidates['match_name'], candidates['stems'])
+        ]
+        # .loc indexes rows even when keep is empty (plain [] would select zero columns)
+        narrowed = candidates.loc[keep]
+        tiers = [match_tier(name, phrase) for name in narrowed['match_name']]
+        return (
+            narrowed.assign(tier=tiers)
+            .sort_values(['tier', 'score', 'shmmitzrach'], kind='stable')
+            .drop(columns='tier')
+        )
+
+    def remember(self, search_term, candidates, complete, db_version):
+        """Keep the candidates of the latest query and their build; an incomplete (capped) set is never narrowed"""
+        self.phrase = " ".join(tokenize(search_term))
+        self.candidates = candidates
+        self.complete = complete
+        self.db_version = db_version
+
+
+def is_code_query(search_term):
+    """Check whether the user typed a (possibly partial) numeric product code"""
+    return search_term.strip().isdigit()
+
+
+class CodeIndex:
+    """Sorted text keys of smlmitzrach and Code for exact and prefix code lookups"""
+
+    def __init__(self, products):
+        entries = sorted(
+            (str(key), code)
+            for code, smlmitzrach in products
+            for key in (smlmitzrach, code)
+            if key is not None
+        )
+        self.keys = [key for key, _ in entries]
+        self.codes = [code for _, code in entries]
+
+    def lookup(self, digits):
+        """Return product codes whose key equals `digits` first, then those it prefixes"""
+        exact = []
+        prefixed = []
+        i = bisect_left(self.keys, digits)
+        while i < len(self.keys) and self.keys[i].startswith(digits):
+            (exact if self.keys[i] == digits else prefixed).append(self.codes[i])
+            i += 1
+        return list(dict.fromkeys(exact + prefixed))
+
+
+def edit_distance(a, b, max_distance):
+    """Optimal string alignment distance, or max_distance + 1 once it is exceeded"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def max_typos(word):
+    """Edit budget for a word: none for very short words, more for longer ones"""
+    if len(word) <= 2:
+        return 0
+    if len(word) <= 4:
+        return 1
+    return 2
+
+
+class FuzzyIndex:
+    """SymSpell-style deletion index over the words of product names.
+
+    The index is frozen into tuples once built, which takes under half the
+    memory of the sets it is collected in. Query words are matched shortest
+    first: short words have small typo budgets and narrow the candidates
+    cheaply, and once at most FUZZY_CANDIDATE_LIMIT products are left the
+    longer words only compute edit distances to words of those products.
+    """
+
+    def __init__(self, products, max_distance=2):
+        self.max_distance = max_distance
+        self.names = {}
+        self.code_words = {}
+        word_codes = defaultdict(set)
+        deletes = defaultdict(set)
+
+        for code, name in products:
+            words = tuple(set(tokenize(name)))
+            self.names[code] = name
+            self.code_words[code] = words
+            for word in words:
+                word_codes[word].add(code)
+
+        for word in word_codes:
+            for variant in self._deletes(word, self.max_distance):
+                deletes[variant].add(word)
+
+        self.word_codes = {word: tuple(codes) for word, codes in word_codes.items()}
+        self.deletes = {variant: tuple(words) for variant, words in deletes.items()}
+
+    @staticmethod
+    def _deletes(word, distance):
+        """All strings reachable from word by deleting up to `distance` characters"""
+        variants = {word}
+        frontier = {word}
+        for _ in range(distance):
+            frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+            variants |= frontier
+        return variants
+
+    def lookup_word(self, word, vocabulary=None):
+        """Return {vocabulary word: distance} for words within the typo budget of `word`.
+
+        With `vocabulary`, only words in it are considered.
+        """
+        budget = min(max_typos(word), self.max_distance)
+        matches = {}
+        checked = set()
+        for variant in self._deletes(word, budget):
+            for candidate in self.deletes.get(variant, ()):
+                if candidate in checked or (vocabulary is not None and candidate not in vocabulary):
+                    continue
+                checked.add(candidate)
+                distance = edit_distance(word, candidate, budget)
+                if distance <= budget:
+                    matches[candidate] = distance
+        return matches
+
+    def search(self, search_term, limit=10):
+        """Return up to `limit` (code, name, distance) tuples, closest first"""
+        tokens = tokenize(search_term)
+        if not tokens:
+            return []
+
+        # Every query word must match some word of the name within its budget
+        best = None
+        for token in sorted(tokens, key=len):
+            vocabulary = None
+            if best is not None and len(best) <= FUZZY_CANDIDATE_LIMIT:
+                vocabulary = {word for code in best for word in self.code_words[code]}
+            token_best = {}
+            for word, distance in self.lookup_word(token, vocabulary).items():
+                for code in self.word_codes[word]:
+                    if distance < token_best.get(code, self.max_distance + 1):
+                        token_best[code] = distance
+            if best is None:
+                best = token_best
+            else:
+                best = {code: best[code] + d for code, d in token_best.items() if code in best}
+            if not best:
+                return []
+
+        ranked = sorted(best.items(), key=lambda item: (item[1], len(self.names[item[0]]), self.names[item[0]]))
+        return [(code, self.names[code], distance) for code, distance in ranked[:limit]]
+
+
+def build_autocomplete_catalog(products, version):
+    """Compact catalog for the browser-side autocomplete.
+
+    Parallel arrays of codes, smlmitzrach and names, plus a map from every
+    two-letter prefix of a name word or prefix-stripped stem to the entries
+    containing it. The browser re-derives the words themselves with the same
+    normalization rules.
+    """
+    codes = []
+    sml_codes = []
+    names = []
+    prefixes = defaultdict(list)
+
+    for i, (code, smlmitzrach, name) in enumerate(products):
+        tokens = tokenize(name)
+        words = tokens + [stem for token in tokens for stem in prefix_stems(token)]
+        codes.append(code)
+        sml_codes.append(smlmitzrach)
+        names.append(name)
+        for prefix in dict.fromkeys(word[:2] for word in words):
+            prefixes[prefix].append(i)
+
+    return {
+        'version': version,
+        'codes': codes,
+        'sml': sml_codes,
+        'names': names,
+        'prefixes': prefixes,
+    }
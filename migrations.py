@@ -0,0 +1,161 @@
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from db_swap import shadow_build
+from delta_import import ensure_change_log
+from hebrew_search import create_search_index, search_index_exists
+from sig_figs import PRECISION_TABLE, write_source_precision
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+# Tables loaded from the source files by setup_db.py; migrations build on them
+BASE_TABLES = ['products', 'units', 'conversions', 'recipes']
+
+# Secondary indexes (lookups by key use the primary keys of a typed build)
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_conv_mida ON conversions(mida)",
+    "CREATE INDEX IF NOT EXISTS idx_recipes_mitzbsisi ON recipes(mitzbsisi)",
+]
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def create_indexes(conn):
+    for statement in INDEXES:
+        conn.execute(statement)
+
+
+def create_retentions_table(conn):
+    """Load the retentions export into databases built before it was part of setup_db.py"""
+    if table_exists(conn, 'retentions'):
+        return
+    # Imported here: setup_db runs the migrations itself
+    from setup_db import SOURCE_FILES, parse_source, write_table
+    write_table(conn, parse_source('retentions', SOURCE_FILES['retentions']))
+
+
+def create_search_table(conn):
+    if not search_index_exists(conn):
+        create_search_index(conn)
+
+
+def create_source_precision(conn):
+    """Record the source-text precision of the products in databases built before it was kept"""
+    if table_exists(conn, PRECISION_TABLE):
+        return
+    # Imported here: setup_db runs the migrations itself
+    from setup_db import SOURCE_FILES, SOURCE_PRECISION, parse_source
+    if not os.path.exists(SOURCE_FILES['products']):
+        # Without the export an empty sidecar is recorded; readers then count from the stored values
+        write_source_precision(conn, SOURCE_PRECISION['products'], [])
+        return
+    parsed = parse_source('products', SOURCE_FILES['products'])
+    write_source_precision(conn, parsed.precision_fields, parsed.precision)
+
+
+# Ordered (version, description, migration) steps. Every step must be safe to
+# run on a database that already has what it creates; append new steps at the
+# end and never renumber or edit a shipped one.
+MIGRATIONS = [
+    (1, "Secondary indexes", create_indexes),
+    (2, "Retentions table", create_retentions_table),
+    (3, "Full-text search index", create_search_table),
+    (4, "Delta import change log", ensure_change_log),
+    (5, "Source precision sidecar", create_source_precision),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    """Schema version recorded in a database; 0 for one that predates versioning"""
+    if not table_exists(conn, SCHEMA_VERSION_TABLE):
+        return 0
+    return conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {SCHEMA_VERSION_TABLE}").fetchone()[0]
+
+
+def database_version(db_path='nutrition.db'):
+    """Schema version of the database file at db_path, read without writing to it"""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        return schema_version(conn)
+    finally:
+        conn.close()
+
+
+def apply_migrations(conn):
+    """Run every migration newer than the database's version on a writable connection.
+
+    The caller owns the transaction. Returns [(version, description, seconds)]
+    for the migrations applied.
+    """
+    missing = [table for table in BASE_TABLES if not table_exists(conn, table)]
+    if missing:
+        raise RuntimeError(f"Tables {missing} are missing; run setup_db.py to build the database")
+
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+    current = schema_version(conn)
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        migration(conn)
+        conn.execute(
+            f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, datetime.now().isoformat(timespec='seconds'))
+        )
+        applied.append((version, description, time.perf_counter() - started))
+    return applied
+
+
+def migrate_database(db_path='nutrition.db'):
+    """Bring a live database up to SCHEMA_VERSION; returns the migrations applied.
+
+    Readers open nutrition.db read-only and immutable, so it is never changed in
+    place: the migrations run in one transaction on a copy that replaces the
+    live file once it validates (see db_swap).
+    """
+    current = database_version(db_path)
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(f"{db_path} has schema version {current}, newer than this code ({SCHEMA_VERSION})")
+    if current == SCHEMA_VERSION:
+        return []
+    with shadow_build(db_path, BASE_TABLES, copy_existing=True) as conn:
+        conn.execute("BEGIN")
+        applied = apply_migrations(conn)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade nutrition.db to the current schema version")
+    parser.add_argument('--db', default='nutrition.db')
+    parser.add_argument('--check', action='store_true', help="Only report the schema version")
+    args = parser.parse_args()
+
+    current = database_version(args.db)
+    print(f"{args.db}: schema version {current} (current code: {SCHEMA_VERSION})")
+    if args.check:
+        return
+
+    applied = migrate_database(args.db)
+    for version, description, seconds in applied:
+        print(f"Applied migration {version}: {description} ({seconds:.2f}s)")
+    if not applied:
+        print("Already up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import json
+import os
+import sqlite3
+import struct
+from urllib.parse import quote
+
+import numpy as np
+
+from nutrition_db import DB_PATH, FIELDS_MAPPING, MAX_CACHED_PROJECTIONS, read_db_version
+from sig_figs import UNKNOWN_PRECISION, count_sig_figs_array, read_source_precision, to_float_array
+
+# Columns of the snapshot, in FIELDS_MAPPING order
+NUTRIENT_FIELDS = list(FIELDS_MAPPING)
+
+MATRIX_MAGIC = b'NUTMTX3\n'
+# Sections start on this boundary so every array is aligned for its dtype
+MATRIX_ALIGNMENT = 64
+
+
+def matrix_path(db_path=DB_PATH):
+    """Snapshot file written next to a database"""
+    return f"{db_path}.nutrients"
+
+
+def _aligned(offset):
+    return -(-offset // MATRIX_ALIGNMENT) * MATRIX_ALIGNMENT
+
+
+class NutrientMatrix:
+    """Products × nutrients snapshot: float64 values, a null mask, significant figures and a code → row index.
+
+    Opened from disk the arrays are numpy memmaps, so opening is zero-copy and
+    every process reading the same file shares its page-cache pages. Values of
+    a NULL cell are NaN and flagged in `missing`. The arrays are read-only.
+    Values are the float64 the database rows hold, so every calculator can
+    work from the snapshot and get the same numbers as from the rows.
+    `sig_figs` is each cell's precision for scale_with_sig_figs: from the
+    source-text sidecar (see read_source_precision) where it has one,
+    otherwise counted from the stored value.
+    """
+
+    def __init__(self, codes, values, missing, sig_figs, fields, db_version=None):
+        self.codes = codes
+        self.values = values
+        self.missing = missing
+        self.sig_figs = sig_figs
+        self.fields = list(fields)
+        self.db_version = db_version
+        for array in (codes, values, missing, sig_figs):
+            array.flags.writeable = False
+        self.row_index = {int(code): row for row, code in enumerate(codes.tolist())}
+        self.field_index = {field: column for column, field in enumerate(self.fields)}
+        self._projections = {}
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a snapshot file"""
+        with open(path, 'rb') as f:
+            if f.read(len(MATRIX_MAGIC)) != MATRIX_MAGIC:
+                raise ValueError(f"{path} is not a nutrient matrix")
+            (header_size,) = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_size))
+        rows, columns = header['rows'], len(header['fields'])
+        codes = np.memmap(path, dtype='<i8', mode='r', offset=header['codes_offset'], shape=(rows,))
+        values = np.memmap(path, dtype='<f8', mode='r', offset=header['values_offset'], shape=(rows, columns))
+        missing = np.memmap(path, dtype=np.bool_, mode='r', offset=header['missing_offset'], shape=(rows, columns))
+        sig_figs = np.memmap(path, dtype=np.int8, mode='r', offset=header['sig_figs_offset'], shape=(rows, columns))
+        return cls(codes, values, missing, sig_figs, header['fields'], header['db_version'])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return int(code) in self.row_index
+
+    def row_indices(self, codes):
+        """Row of each code, -1 for None, NaN or a code that is not in the snapshot"""
+        return np.array(
+            [self.row_index.get(int(code), -1) if code is not None and code == code else -1 for code in codes],
+            dtype=np.intp
+        )
+
+    def column_indices(self, fields):
+        """Columns of a field set, resolved once per field set"""
+        fields = tuple(fields)
+        columns = self._projections.get(fields)
+        if columns is None:
+            if len(self._projections) >= MAX_CACHED_PROJECTIONS:
+                self._projections.clear()
+            columns = np.array([self.field_index[field] for field in fields], dtype=np.intp)
+            columns.flags.writeable = False
+            self._projections[fields] = columns
+        return columns
+
+    def take(self, codes, fields=None):
+        """(values, missing, found) for the given codes and fields, one row per code.
+
+        Rows of unknown codes are NaN, all missing, and False in `found`.
+        """
+        rows, columns, found = self._locate(codes, fields)
+        values = self._slice(self.values, rows, columns, found, np.nan)
+        missing = self._slice(self.missing, rows, columns, found, True)
+        return values, missing, found
+
+    def take_sig_figs(self, codes, fields=None):
+        """(values, sig_figs, found) for the given codes and fields, one row per code.
+
+        Rows of unknown codes are NaN with precision 0, and False in `found`.
+        """
+        rows, columns, found = self._locate(codes, fields)
+        values = self._slice(self.values, rows, columns, found, np.nan)
+        sig_figs = self._slice(self.sig_figs, rows, columns, found, 0)
+        return values, sig_figs, found
+
+    def _locate(self, codes, fields):
+        rows = self.row_indices(codes)
+        columns = self.column_indices(fields) if fields is not None else np.arange(len(self.fields))
+        return rows, columns, rows >= 0
+
+    @staticmethod
+    def _slice(array, rows, columns, found, fill):
+        result = np.full((len(rows), len(columns)), fill, dtype=array.dtype)
+        result[found] = array[np.ix_(rows[found], columns)]
+        return result
+
+
+def read_nutrient_arrays(conn, fields=NUTRIENT_FIELDS):
+    """(codes, values, missing, sig_figs) of every product, in Code order"""
+    column_list = ", ".join(f'"{field}"' for field in fields)
+    rows = conn.execute(f'SELECT Code, {column_list} FROM products ORDER BY Code').fetchall()
+    codes = np.array([row[0] for row in rows], dtype='<i8')
+    # NULL and text float() rejects are missing
+    data = np.array([to_float_array(row[1:]) for row in rows], dtype='<f8').reshape(len(rows), len(fields))
+    missing = np.isnan(data)
+    precision = read_source_precision(conn, list(fields)) or {}
+    sig_figs = []
+    for row in rows:
+        # Counted from the stored value (its SQLite type matters) where the sidecar has no precision
+        counts = precision.get(row[0])
+        if counts is None:
+            counts = count_sig_figs_array(row[1:])
+        elif (counts == UNKNOWN_PRECISION).any():
+            counts = np.where(counts == UNKNOWN_PRECISION, count_sig_figs_array(row[1:]), counts)
+        sig_figs.append(counts)
+    sig_figs = np.array(sig_figs, dtype=np.int8).reshape(len(rows), len(fields))
+    return codes, data, missing, sig_figs
+
+
+def write_nutrient_matrix(path, codes, values, missing, sig_figs, fields, db_version):
+    """Write a snapshot file atomically (readers see the old file or the new one)"""
+    columns = len(fields)
+    header = {'db_version': db_version, 'rows': len(codes), 'fields': list(fields)}
+    # Offsets depend on the header size, which depends on the offsets; reserve room for them first
+    header.update(codes_offset=0, values_offset=0, missing_offset=0, sig_figs_offset=0)
+    header_size = len(json.dumps(header).encode()) + 64
+    codes_offset = _aligned(len(MATRIX_MAGIC) + 4 + header_size)
+    values_offset = _aligned(codes_offset + len(codes) * 8)
+    missing_offset = _aligned(values_offset + len(codes) * columns * 8)
+    sig_figs_offset = _aligned(missing_offset + len(codes) * columns)
+    header.update(
+        codes_offset=codes_offset, values_offset=values_offset, missing_offset=missing_offset, sig_figs_offset=sig_figs_offset
+    )
+    encoded = json.dumps(header).encode().ljust(header_size)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MATRIX_MAGIC + struct.pack('<I', header_size) + encoded)
+            for offset, array in (
+                (codes_offset, np.ascontiguousarray(codes, dtype='<i8')),
+                (values_offset, np.ascontiguousarray(values, dtype='<f8')),
+                (missing_offset, np.ascontiguousarray(missing, dtype=np.bool_)),
+                (sig_figs_offset, np.ascontiguousarray(sig_figs, dtype=np.int8)),
+            ):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def build_nutrient_matrix(conn, db_version):
+    """In-memory snapshot of the database build conn reads from"""
+    codes, values, missing, sig_figs = read_nutrient_arrays(conn)
+    return NutrientMatrix(codes, values, missing, sig_figs, NUTRIENT_FIELDS, db_version)
+
+
+def save_nutrient_matrix(matrix, path):
+    write_nutrient_matrix(
+        path, matrix.codes, matrix.values, matrix.missing, matrix.sig_figs, matrix.fields, matrix.db_version
+    )
+
+
+def export_nutrient_matrix(db_path=DB_PATH):
+    """Write the snapshot file of the database now on disk (run by the import scripts after publishing).
+
+    Returns the snapshot, or None if the database was replaced while it was
+    being read; the next reader then builds it.
+    """
+    db_version = read_db_version(db_path)
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        matrix = build_nutrient_matrix(conn, db_version)
+    finally:
+        conn.close()
+    if read_db_version(db_path) != db_version:
+        return None
+    save_nutrient_matrix(matrix, matrix_path(db_path))
+    return matrix
+
+
+def open_nutrient_matrix(conn, db_version, db_path=DB_PATH):
+    """Memory-mapped snapshot of a database build, rebuilt from conn if the file is missing or stale.
+
+    conn must read the build identified by db_version. The file is only
+    (re)written while that build is still the one on disk; a snapshot of an
+    older build is served from memory.
+    """
+    path = matrix_path(db_path)
+    try:
+        matrix = NutrientMatrix.load(path)
+        if matrix.db_version == db_version and matrix.fields == NUTRIENT_FIELDS:
+            return matrix
+    except (OSError, ValueError, KeyError):
+        pass
+
+    matrix = build_nutrient_matrix(conn, db_version)
+    if read_db_version(db_path) == db_version:
+        save_nutrient_matrix(matrix, path)
+        try:
+            mapped = NutrientMatrix.load(path)
+            if mapped.db_version == db_version:
+                return mapped
+        except (OSError, ValueError, KeyError):
+            pass
+    return matrix
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from nutrition_db import FIELDS_MAPPING
+from sig_figs import to_float_array
+
+# Layout of every vector: one float64 per FIELDS_MAPPING field, in its order
+VECTOR_FIELDS = list(FIELDS_MAPPING)
+VECTOR_INDEX = {field: position for position, field in enumerate(VECTOR_FIELDS)}
+
+
+class NutrientVector:
+    """Amounts of every FIELDS_MAPPING nutrient in a fixed-layout float64 array.
+
+    The calculators add, scale and normalize whole vectors instead of looping
+    over {field: value} dicts. Converting from a dict or Series treats a
+    missing, None or non-numeric value as 0; to_dict/to_series give back the
+    shapes the display code uses. Operations return new vectors.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = np.zeros(len(VECTOR_FIELDS), dtype=np.float64)
+        else:
+            values = np.array(values, dtype=np.float64)
+            if values.shape != (len(VECTOR_FIELDS),):
+                raise ValueError(f"A nutrient vector has {len(VECTOR_FIELDS)} values, got shape {values.shape}")
+        self.values = values
+
+    @classmethod
+    def from_dict(cls, mapping, default=0.0):
+        """Vector of a {field: value} mapping; absent, None and non-numeric values become default"""
+        values = to_float_array([mapping.get(field) for field in VECTOR_FIELDS])
+        return cls(np.where(np.isnan(values), default, values))
+
+    @classmethod
+    def from_series(cls, series, default=0.0):
+        """Vector of a Series indexed by field (a product row); other entries are ignored"""
+        values = pd.to_numeric(series.reindex(VECTOR_FIELDS), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        return cls(np.where(np.isnan(values), default, values))
+
+    @classmethod
+    def weighted_sum(cls, rows, weights):
+        """Sum of the rows of an item × field matrix in vector layout, each times its item's weight"""
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(VECTOR_FIELDS))
+        return cls((rows * np.asarray(weights, dtype=np.float64)[:, None]).sum(axis=0))
+
+    @classmethod
+    def total(cls, vectors):
+        """Sum of vectors, added in order"""
+        result = cls()
+        for vector in vectors:
+            result = result + vector
+        return result
+
+    def __add__(self, other):
+        if not isinstance(other, NutrientVector):
+            return NotImplemented
+        return NutrientVector(self.values + other.values)
+
+    def __mul__(self, scalar):
+        if isinstance(scalar, NutrientVector):
+            return NotImplemented
+        return NutrientVector(self.values * float(scalar))
+
+    __rmul__ = __mul__
+
+    def scale_fields(self, multipliers):
+        """Each field times its own multiplier (a vector or a vector-layout row, e.g. retention factors)"""
+        if isinstance(multipliers, NutrientVector):
+            multipliers = multipliers.values
+        return NutrientVector(self.values * multipliers)
+
+    def normalize(self, weight, per=100.0):
+        """Amounts in `weight` grams rescaled to `per` grams; all zeros for a weight that is not positive"""
+        if weight <= 0:
+            return NutrientVector()
+        return NutrientVector(self.values / weight * per)
+
+    def __getitem__(self, field):
+        return float(self.values[VECTOR_INDEX[field]])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        return isinstance(other, NutrientVector) and np.array_equal(self.values, other.values)
+
+    __hash__ = None
+
+    def __repr__(self):
+        nonzero = {field: value for field, value in self.to_dict().items() if value}
+        return f"NutrientVector({nonzero})"
+
+    def to_dict(self, fields=None):
+        """{field: float} of all fields, or only of `fields`"""
+        if fields is None:
+            return dict(zip(VECTOR_FIELDS, self.values.tolist()))
+        return {field: float(self.values[VECTOR_INDEX[field]]) for field in fields}
+
+    def to_series(self, fields=None):
+        """Series of all fields, or only of `fields`, indexed by field"""
+        if fields is None:
+            return pd.Series(self.values, index=VECTOR_FIELDS, dtype=np.float64)
+        return pd.Series(self.values[[VECTOR_INDEX[field] for field in fields]], index=list(fields), dtype=np.float64)
+
+
+def mix_per_100g(values, weights, loss_factors, oil_values, oil_weights, total_weight):
+    """Nutrients of 100 g of a mix, computed for all ingredients at once.
+
+    values and oil_values are ingredient × nutrient matrices (per 100 g, 0 for
+    missing values): the ingredient after its cooking method's retention (see
+    nutrition_db.RetentionMatrix) and the oil it absorbs (zeros for none).
+    weights and oil_weights are grams per ingredient, loss_factors the fraction each
+    ingredient keeps after nutrient loss. total_weight is the weight of the
+    finished mix, oil included.
+    """
+    contributions = NutrientVector.weighted_sum(values, weights / 100.0 * loss_factors)
+    oil = NutrientVector.weighted_sum(oil_values, oil_weights / 100.0)
+    return (contributions + oil) * (100.0 / total_weight)
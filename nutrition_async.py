@@ -0,0 +1,215 @@
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from db_pool import ConnectionPool
+from hebrew_search import CodeIndex, is_code_query, search_index_exists
+from migrations import SCHEMA_VERSION, database_version
+from nutrition_db import (
+    AVAILABLE_UNITS_SQL, DB_PATH, RECIPE_DETAILS_SQL, RETENTION_OPTIONS_SQL, SEARCH_COUNT_CAP, SEARCH_PAGE_SIZE,
+    ProductCatalog, advanced_search_sql, like_search_sql, name_candidates_sql, products_by_codes_sql, query_product_fields,
+    query_retention_factors, read_db_version
+)
+
+SearchHit = namedtuple('SearchHit', ['Code', 'smlmitzrach', 'shmmitzrach'])
+
+
+@lru_cache(maxsize=128)
+def row_type(name, columns):
+    """Named tuple type for a result shape; invalid or duplicate column names are renamed"""
+    return namedtuple(name, columns, rename=True)
+
+
+def fetch_rows(conn, name, query, params=()):
+    """Run a query and return its rows as named tuples"""
+    cursor = conn.execute(query, params)
+    make_row = row_type(name, tuple(column[0] for column in cursor.description))._make
+    return [make_row(row) for row in cursor]
+
+
+def as_row(name, mapping):
+    """Named tuple for one mapping row (a catalog or retention row), or None"""
+    if mapping is None:
+        return None
+    return row_type(name, tuple(mapping))._make(mapping.values())
+
+
+class _Call:
+    """One blocking lookup on a worker thread that can be interrupted mid-query.
+
+    The pool is resolved on the worker too: checking the database version
+    stats the file and may open a new pool and close the old one.
+    """
+
+    def __init__(self, get_pool, fn, args):
+        self.get_pool = get_pool
+        self.fn = fn
+        self.args = args
+        self.conn = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        with self.get_pool().connection() as conn:
+            with self.lock:
+                if self.cancelled:
+                    return None
+                self.conn = conn
+            try:
+                return self.fn(conn, *self.args)
+            finally:
+                with self.lock:
+                    self.conn = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.interrupt()
+
+
+class AsyncNutritionDB:
+    """asyncio access to the nutrition lookups for services outside Streamlit.
+
+    Queries run on a bounded thread pool over a read-only connection pool; at
+    most `max_concurrency` lookups are in flight and the rest wait their turn.
+    Cancelling the awaiting task interrupts a query that is already running.
+    Results are lists of named tuples (or a single named tuple) instead of
+    DataFrames. A rebuilt nutrition.db is picked up on the next call; a
+    database on another schema version raises RuntimeError.
+    """
+
+    def __init__(self, path=DB_PATH, max_workers=4, max_concurrency=16):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nutrition-async")
+        self._max_connections = max_workers
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._version = None
+        self._pool = None
+        self._catalog = None
+        self._code_index = None
+
+    def _current_pool(self):
+        """Pool for the database build on disk, replacing the previous one when the file changed"""
+        version = read_db_version(self.path)
+        with self._lock:
+            if version != self._version:
+                # Fail fast instead of querying a schema this code does not know (see migrations.py)
+                schema = database_version(self.path)
+                if schema != SCHEMA_VERSION:
+                    raise RuntimeError(f"{self.path} has schema version {schema}, expected {SCHEMA_VERSION}; run migrations.py")
+                if self._pool is not None:
+                    self._pool.close()
+                self._version = version
+                self._pool = ConnectionPool(self.path, max_connections=self._max_connections)
+                self._catalog = None
+                self._code_index = None
+            return self._pool
+
+    def _product_catalog(self, conn):
+        with self._lock:
+            catalog, version = self._catalog, self._version
+        if catalog is None:
+            catalog = ProductCatalog(conn)
+            with self._lock:
+                if self._version == version:
+                    self._catalog = catalog
+        return catalog
+
+    def _lookup_codes(self, conn, digits):
+        with self._lock:
+            code_index, version = self._code_index, self._version
+        if code_index is None:
+            code_index = CodeIndex(conn.execute("SELECT Code, smlmitzrach FROM products").fetchall())
+            with self._lock:
+                if self._version == version:
+                    self._code_index = code_index
+        return code_index.lookup(digits)
+
+    async def _run(self, fn, *args):
+        async with self._semaphore:
+            call = _Call(self._current_pool, fn, args)
+            future = asyncio.get_running_loop().run_in_executor(self._executor, call.run)
+            try:
+                return await future
+            except asyncio.CancelledError:
+                call.cancel()
+                raise
+
+    async def search_foods(self, search_term, page=0, page_size=SEARCH_PAGE_SIZE):
+        """Search by smlmitzrach/Code or ranked name; returns (hits, total)"""
+        return await self._run(self._search_foods, search_term, page, page_size)
+
+    def _search_foods(self, conn, search_term, page, page_size):
+        if is_code_query(search_term):
+            codes = self._lookup_codes(conn, search_term.strip())
+            if codes:
+                page_codes = codes[page * page_size:(page + 1) * page_size]
+                query, params = products_by_codes_sql(page_codes)
+                found = {row[0]: SearchHit._make(row) for row in conn.execute(query, params)}
+                return [found[code] for code in page_codes if code in found], len(codes)
+
+        if not search_index_exists(conn):
+            query, params, count_query, count_params = like_search_sql(
+                search_term, page, page_size, False, SEARCH_COUNT_CAP
+            )
+            hits = [SearchHit._make(row) for row in conn.execute(query, params)]
+            return hits, conn.execute(count_query, count_params).fetchone()[0]
+
+        sql = name_candidates_sql(search_term, False, SEARCH_COUNT_CAP)
+        if sql is None:
+            return [], 0
+        candidates = conn.execute(*sql).fetchall()
+        page_rows = candidates[page * page_size:(page + 1) * page_size]
+        return [SearchHit._make(row[:3]) for row in page_rows], len(candidates)
+
+    async def advanced_search(self, conditions, columns=None):
+        """Products matching the advanced-search conditions, ordered by name"""
+        sql = advanced_search_sql(conditions, columns)
+        if sql is None:
+            return []
+        return await self._run(fetch_rows, 'Product', *sql)
+
+    async def get_food_details(self, food_code, fields=None):
+        """Nutritional details for a specific food (optionally only `fields`), or None"""
+        return await self._run(self._food_details, food_code, fields)
+
+    def _food_details(self, conn, food_code, fields):
+        catalog = self._product_catalog(conn)
+        if fields is None:
+            return as_row('Product', catalog.get(food_code))
+        # Only the requested columns are read, through one cached statement per field set
+        fields = [field for field in fields if field in catalog.columns]
+        return as_row('Product', query_product_fields(conn, [food_code], fields).get(food_code))
+
+    async def get_available_units(self, food_code):
+        """Units of measure for a specific food"""
+        return await self._run(fetch_rows, 'Unit', AVAILABLE_UNITS_SQL, (food_code,))
+
+    async def get_recipe_details(self, recipe_code):
+        """Components of a recipe"""
+        return await self._run(fetch_rows, 'RecipeComponent', RECIPE_DETAILS_SQL, (recipe_code,))
+
+    async def get_retention_options(self):
+        """Retention cooking methods, ordered by Hebrew name"""
+        return await self._run(fetch_rows, 'RetentionOption', RETENTION_OPTIONS_SQL)
+
+    async def get_retention_factors(self, retention_code):
+        """Retention factors for a specific cooking method, or None"""
+        factors = await self.get_retention_factors_bulk([retention_code])
+        return factors.get(retention_code)
+
+    async def get_retention_factors_bulk(self, retention_codes):
+        """Retention factors for several cooking methods in one query, as {code: factors}"""
+        rows = await self._run(query_retention_factors, retention_codes)
+        return {code: as_row('RetentionFactors', row) for code, row in rows.items()}
+
+    def close(self):
+        """Stop the worker threads and close the connections"""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
@@ -0,0 +1,415 @@
+import json
+import os
+from functools import lru_cache
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
+from hebrew_search import build_match_query, tokenize
+from sig_figs import to_float_array
+
+DB_PATH = 'nutrition.db'
+
+SEARCH_PAGE_SIZE = 50
+# Result counts above this are reported as an estimate ("1000+") instead of counted exactly
+SEARCH_COUNT_CAP = 1000
+
+# SQLite's default limit on bound parameters in one statement
+MAX_QUERY_PARAMS = 999
+
+# Distinct field sets whose projection (SQL text or snapshot columns) is kept compiled
+MAX_CACHED_PROJECTIONS = 64
+
+# Nutrient columns of products shown and calculated by the app, with their Hebrew labels
+FIELDS_MAPPING = {
+    # Macronutrients
+    'food_energy': 'קלוריות (קק"ל)',
+    'protein': 'חלבון (גרם)',
+    'total_fat': 'שומן כולל (גרם)',
+    'carbohydrates': 'פחמימות (גרם)',
+    'total_dietary_fiber': 'סיבים תזונתיים (גרם)',
+    'total_sugars': 'סוכרים (גרם)',
+    'alcohol': 'אלכוהול (גרם)',
+    'moisture': 'לחות (גרם)',
+    
+    # Fats
+    'saturated_fat': 'שומן רווי (גרם)',
+    'mono_unsaturated_fat': 'שומן חד בלתי רווי (גרם)',
+    'poly_unsaturated_fat': 'שומן רב בלתי רווי (גרם)',
+    'trans_fatty_acids': 'שומן טרנס (גרם)',
+    'cholesterol': 'כולסטרול (מ"ג)',
+    'linoleic': 'חומצה לינולאית (אומגה 6) (גרם)',
+    'linolenic': 'חומצה לינולנית (אומגה 3) (גרם)',
+    'oleic': 'חומצה אולאית (גרם)',
+    'docosahexanoic': 'DHA (גרם)',
+    'eicosapentaenoic': 'EPA (גרם)',
+    'arachidonic': 'חומצה ארכידונית (גרם)',
+    
+    # Vitamins
+    'vitamin_a_iu': 'ויטמין A (יחב"ל)',
+    'vitamin_a_re': 'ויטמין A (מק"ג RE)',
+    'carotene': 'קרוטן (מק"ג)',
+    'vitamin_e': 'ויטמין E (מ"ג)',
+    'vitamin_c': 'ויטמין C (מ"ג)',
+    'thiamin': 'תיאמין B1 (מ"ג)',
+    'riboflavin': 'ריבופלאבין B2 (מ"ג)',
+    'niacin': 'ניאצין B3 (מ"ג)',
+    'vitamin_b6': 'ויטמין B6 (מ"ג)',
+    'folate': 'חומצה פולית (מק"ג)',
+    'vitamin_b12': 'ויטמין B12 (מק"ג)',
+    'vitamin_d': 'ויטמין D (מק"ג)',
+    'vitamin_k': 'ויטמין K (מק"ג)',
+    'pantothenic_acid': 'חומצה פנטותנית (מ"ג)',
+    'biotin': 'ביוטין (מק"ג)',
+    'choline': 'כולין (מ"ג)',
+    
+    # Minerals
+    'calcium': 'סידן (מ"ג)',
+    'iron': 'ברזל (מ"ג)',
+    'magnesium': 'מגנזיום (מ"ג)',
+    'phosphorus': 'זרחן (מ"ג)',
+    'potassium': 'אשלגן (מ"ג)',
+    'sodium': 'נתרן (מ"ג)',
+    'zinc': 'אבץ (מ"ג)',
+    'copper': 'נחושת (מ"ג)',
+    'manganese': 'מנגן (מ"ג)',
+    'selenium': 'סלניום (מק"ג)',
+    'iodine': 'יוד (מק"ג)',
+    
+    # Amino Acids
+    'isoleucine': 'איזולאוצין (גרם)',
+    'leucine': 'לאוצין (גרם)',
+    'valine': 'ואלין (גרם)',
+    'lysine': 'ליזין (גרם)',
+    'methionine': 'מתיונין (גרם)',
+    'phenylalanine': 'פנילאלנין (גרם)',
+    'threonine': 'תראונין (גרם)',
+    'tryptophan': 'טריפטופן (גרם)',
+    'histidine': 'היסטידין (גרם)',
+    'arginine': 'ארגינין (גרם)',
+    
+    # Other
+    'fructose': 'פרוקטוז (גרם)',
+    'sugar_alcohols': 'רב כהלים (גרם)'
+}
+
+
+# Mapping from product nutrition fields to retention factor columns
+RETENTION_FIELD_MAPPING = {
+    'vitamin_b12': 'vitamin_b12',
+    'folate': 'folate',
+    'vitamin_b6': 'vitamin_b6',
+    'niacin': 'niacin',
+    'riboflavin': 'riboflavin',
+    'thiamin': 'thiamin',
+    'vitamin_c': 'vitamin_c',
+    'carotene': 'carotene',
+    'vitamin_a_re': 'vitamin_a_re',
+    'vitamin_a_iu': 'vitamin_a_iu',
+    'copper': 'copper',
+    'zinc': 'zinc',
+    'sodium': 'sodium',
+    'potassium': 'potassium',
+    'phosphorus': 'phosphorus',
+    'magnesium': 'magnesium',
+    'iron': 'iron',
+    'calcium': 'calcium'
+}
+
+
+def read_db_version(path=DB_PATH):
+    """Identify the database build on disk; a file swapped in by rename has a new inode and mtime"""
+    stat = os.stat(path)
+    return f"{stat.st_ino}-{stat.st_mtime_ns}"
+
+
+class ProductCatalog:
+    """Every product row with all nutrients, keyed by Code.
+
+    Rows are read straight from the cursor, so each value keeps the type SQLite
+    stored it with (an integer stays 24, not 24.0, and NULL stays None), which
+    the significant-figure logic relies on. Rows are shared between sessions
+    and exposed read-only.
+    """
+
+    def __init__(self, conn):
+        cursor = conn.execute("SELECT * FROM products")
+        self.columns = [column[0] for column in cursor.description]
+        code_index = self.columns.index('Code')
+        self.rows = {
+            row[code_index]: MappingProxyType(dict(zip(self.columns, row)))
+            for row in cursor
+        }
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def get(self, code):
+        """Nutritional details for a product (the shared read-only row), or None if the code is unknown"""
+        return self.rows.get(code)
+
+
+@lru_cache(maxsize=MAX_CACHED_PROJECTIONS)
+def product_fields_sql(fields):
+    """SELECT for one field set; the text depends only on the fields, so SQLite's statement cache reuses it"""
+    columns = ", ".join('"{}"'.format(field.replace('"', '""')) for field in ('Code',) + fields)
+    return f"SELECT {columns} FROM products WHERE Code IN (SELECT value FROM json_each(?))"
+
+
+def query_product_fields(conn, food_codes, fields):
+    """Get only `fields` for several products in one query, as {code: {field: value}}"""
+    fields = tuple(field for field in fields if field != 'Code')
+    # numpy scalars are not JSON serializable, and NaN (a missing code) is not valid JSON
+    codes = [
+        code.item() if hasattr(code, 'item') else code
+        for code in food_codes
+        if code is not None and code == code
+    ]
+    cursor = conn.execute(product_fields_sql(fields), (json.dumps(codes),))
+    return {row[0]: dict(zip(fields, row[1:])) for row in cursor}
+
+
+def query_rows_by_key(conn, table, key_column, keys):
+    """Fetch every row whose key is in `keys` with one IN query (per MAX_QUERY_PARAMS keys), as {key: row}"""
+    # numpy integers would be bound as blobs and never match, so pass plain Python values
+    keys = list(dict.fromkeys(
+        key.item() if hasattr(key, 'item') else key
+        for key in keys
+        if key is not None
+    ))
+    rows = {}
+    for start in range(0, len(keys), MAX_QUERY_PARAMS):
+        chunk = keys[start:start + MAX_QUERY_PARAMS]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor = conn.execute(f'SELECT * FROM {table} WHERE "{key_column}" IN ({placeholders})', chunk)
+        columns = [column[0] for column in cursor.description]
+        key_index = columns.index(key_column)
+        for row in cursor:
+            rows[row[key_index]] = MappingProxyType(dict(zip(columns, row)))
+    return rows
+
+
+def query_retention_factors(conn, retention_codes):
+    """Get retention factors for several cooking methods, as {retention_code: row}"""
+    return query_rows_by_key(conn, 'retentions', 'retention_code', retention_codes)
+
+
+AVAILABLE_UNITS_SQL = """
+    SELECT c.mida, c.mishkal, u.shmmida
+    FROM conversions c
+    JOIN units u ON c.mida = u.smlmida
+    WHERE c.mmitzrach = ?
+    ORDER BY u.shmmida
+"""
+
+RECIPE_DETAILS_SQL = """
+    SELECT r.*, p.shmmitzrach
+    FROM recipes r
+    LEFT JOIN products p ON r.mitzbsisi = p.Code
+    WHERE r.mmitzrach = ?
+"""
+
+RETENTION_OPTIONS_SQL = """
+    SELECT retention_code, retention_name, hebrew_name 
+    FROM retentions 
+    ORDER BY hebrew_name
+"""
+
+RETENTION_FACTORS_SQL = "SELECT * FROM retentions"
+
+# Columns shown by the advanced search when the caller does not choose any
+ADVANCED_SEARCH_DEFAULT_COLUMNS = "Code, shmmitzrach, protein, total_fat, carbohydrates, food_energy"
+
+
+def query_available_units(conn, food_code):
+    """Get available units for a specific food"""
+    return pd.read_sql_query(AVAILABLE_UNITS_SQL, conn, params=(food_code,))
+
+
+def query_recipe_details(conn, recipe_code):
+    """Get components of a recipe"""
+    return pd.read_sql_query(RECIPE_DETAILS_SQL, conn, params=(recipe_code,))
+
+
+class RetentionMatrix:
+    """Retention factors of every cooking method, loaded once per database build.
+
+    `factors` is a dense retention_code × RETENTION_FIELD_MAPPING matrix of
+    retained fractions (percentage / 100; 1 for a missing or non-numeric
+    factor), with `code_index` giving each code's row. The method list is
+    kept too, so the label page needs no query for it.
+    """
+
+    def __init__(self, conn):
+        table = pd.read_sql_query(RETENTION_FACTORS_SQL, conn)
+        self.options = pd.read_sql_query(RETENTION_OPTIONS_SQL, conn)
+        self.codes = table['retention_code'].tolist()
+        self.code_index = {code: row for row, code in enumerate(self.codes)}
+        fields = list(FIELDS_MAPPING)
+        self.field_positions = np.array([fields.index(field) for field in RETENTION_FIELD_MAPPING], dtype=np.intp)
+        percentages = np.full((len(table), len(RETENTION_FIELD_MAPPING)), np.nan, dtype=np.float64)
+        for position, column in enumerate(RETENTION_FIELD_MAPPING.values()):
+            if column in table:
+                percentages[:, position] = to_float_array(table[column].tolist())
+        self.factors = np.where(np.isnan(percentages), 100.0, percentages) / 100.0
+        self.factors.flags.writeable = False
+
+    def __contains__(self, retention_code):
+        return retention_code in self.code_index
+
+    def multipliers(self, retention_codes):
+        """One row of multipliers per code, in FIELDS_MAPPING order (the NutrientVector layout); all 1 for None or an unknown code"""
+        rows = np.ones((len(retention_codes), len(FIELDS_MAPPING)), dtype=np.float64)
+        index = np.array([self.code_index.get(code, -1) for code in retention_codes], dtype=np.intp)
+        found = np.nonzero(index >= 0)[0]
+        rows[np.ix_(found, self.field_positions)] = self.factors[index[found]]
+        return rows
+
+
+def escape_like(text):
+    """Escape LIKE wildcards so the text only matches literally"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def tier_order_sql():
+    """ORDER BY expression for the relevance tiers: exact name, prefix, word start, anything else"""
+    return """
+        CASE
+            WHEN match_name = ? THEN 0
+            WHEN match_name LIKE ? ESCAPE '\\' THEN 1
+            WHEN match_name LIKE ? ESCAPE '\\' THEN 2
+            ELSE 3
+        END
+    """
+
+
+def tier_params(phrase):
+    """Parameters for tier_order_sql()"""
+    escaped = escape_like(phrase)
+    return [phrase, f'{escaped}%', f'% {escaped}%']
+
+
+def products_by_codes_sql(codes):
+    """(query, params) fetching Code, smlmitzrach and shmmitzrach for the given codes, in any order"""
+    placeholders = ", ".join("?" * len(codes))
+    query = f"SELECT Code, smlmitzrach, shmmitzrach FROM products WHERE Code IN ({placeholders})"
+    return query, list(codes)
+
+
+def like_search_sql(search_term, page, page_size, recipes_only, count_cap):
+    """(query, params, count_query, count_params) for the ranked LIKE scan used without a search index"""
+    recipe_filter = "AND Code IN (SELECT mmitzrach FROM recipes)" if recipes_only else ""
+    phrase = search_term.strip()
+    hits = f"""
+    SELECT Code, smlmitzrach, shmmitzrach, shmmitzrach AS match_name
+    FROM products
+    WHERE shmmitzrach LIKE ? ESCAPE '\\' {recipe_filter}
+    """
+    hit_params = [f'%{escape_like(phrase)}%']
+    
+    query = f"""
+    SELECT Code, smlmitzrach, shmmitzrach
+    FROM ({hits})
+    ORDER BY {tier_order_sql()}, shmmitzrach
+    LIMIT ? OFFSET ?
+    """
+    params = hit_params + tier_params(phrase) + [page_size, page * page_size]
+    
+    # Counting stops past the cap; larger totals are shown as an estimate
+    count_query = f"SELECT COUNT(*) FROM ({hits} LIMIT {count_cap + 1})"
+    return query, params, count_query, hit_params
+
+
+def name_candidates_sql(search_term, recipes_only, count_cap):
+    """(query, params) for every ranked FTS match up to the count cap, or None if there is nothing to match"""
+    match_query = build_match_query(search_term)
+    if not match_query:
+        return None
+    
+    recipe_filter = "AND p.Code IN (SELECT mmitzrach FROM recipes)" if recipes_only else ""
+    # Tiers are judged on the normalized name stored in the index
+    phrase = " ".join(tokenize(search_term))
+    query = f"""
+    SELECT * FROM (
+        SELECT p.Code, p.smlmitzrach, p.shmmitzrach,
+               products_fts.name AS match_name, products_fts.stems AS stems, products_fts.rank AS score
+        FROM products_fts
+        JOIN products p ON p.Code = products_fts.rowid
+        WHERE products_fts MATCH ? {recipe_filter}
+    )
+    ORDER BY {tier_order_sql()}, score, shmmitzrach
+    LIMIT {count_cap + 1}
+    """
+    return query, [match_query] + tier_params(phrase)
+
+
+def advanced_search_sql(conditions, columns=None):
+    """(query, params) for an advanced search with individual AND/OR operators, or None if no condition applies"""
+    if not conditions:
+        return None
+    
+    # Build WHERE clause with individual operators
+    where_parts = []
+    params = []
+    
+    for i, cond in enumerate(conditions):
+        field = cond['field']
+        operator = cond['operator']
+        value = cond['value']
+        
+        # Build condition SQL
+        if operator == 'שווה' or operator == '=':
+            condition_sql = f"{field} = ?"
+            params.append(value)
+        elif operator == 'גדול מ' or operator == '>':
+            condition_sql = f"{field} > ?"
+            params.append(value)
+        elif operator == 'קטן מ' or operator == '<':
+            condition_sql = f"{field} < ?"
+            params.append(value)
+        elif operator == 'גדול שווה' or operator == '>=':
+            condition_sql = f"{field} >= ?"
+            params.append(value)
+        elif operator == 'קטן שווה' or operator == '<=':
+            condition_sql = f"{field} <= ?"
+            params.append(value)
+        elif operator == 'בין':
+            if 'value2' in cond:
+                condition_sql = f"{field} BETWEEN ? AND ?"
+                params.extend([value, cond['value2']])
+            else:
+                continue
+        else:
+            continue
+        
+        # Add to parts with logic operator
+        if i == 0:
+            where_parts.append(condition_sql)
+        else:
+            # Get the logic operator from the previous condition
+            logic_op = conditions[i-1].get('next_operator', 'AND')
+            where_parts.append(f" {logic_op} {condition_sql}")
+    
+    if not where_parts:
+        return None
+    
+    # Combine all parts
+    where_clause = "".join(where_parts)
+    
+    # Determine columns to select
+    if columns:
+        # Ensure Code and shmmitzrach are always present
+        cols_to_select = ['Code', 'shmmitzrach'] + [c for c in columns if c not in ['Code', 'shmmitzrach']]
+        select_clause = ", ".join(cols_to_select)
+    else:
+        select_clause = ADVANCED_SEARCH_DEFAULT_COLUMNS
+
+    query = f"""
+    SELECT {select_clause}
+    FROM products 
+    WHERE {where_clause}
+    ORDER BY shmmitzrach
+    """
+    return query, params
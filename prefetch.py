@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from query_cache import MISSING
+
+
+class Prefetcher:
+    """Warms a shared query cache with per-code lookups on a small thread pool.
+
+    `loaders` maps a lookup name to a function `(conn, code) -> value`. Results
+    are stored in `cache` (a QueryCache) under `(name, version, (code,))`, the
+    same key an on-demand lookup uses. Loads run on connections checked out of
+    the current build's `connection` factory (a connection pool).
+    """
+
+    def __init__(self, loaders, cache, max_workers=2):
+        self.loaders = loaders
+        self.cache = cache
+        self.version = None
+        self.connection = None
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+    def ensure_version(self, version, connection):
+        """Move to a newer database build, loading from its `connection` and forgetting older in-flight loads.
+
+        Only the build the shared cache accepts as current is taken (see
+        QueryCache.ensure_version); a caller on a replaced build, or on the
+        build already in use, changes nothing.
+        """
+        if not self.cache.ensure_version(version):
+            return
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self.connection = connection
+                self._pending.clear()
+
+    def prefetch(self, codes):
+        """Queue every loader for each code that is neither cached nor already in flight"""
+        with self._lock:
+            version = self.version
+            connection = self.connection
+            for code in codes:
+                for name in self.loaders:
+                    key = (name, version, (code,))
+                    if key in self._pending or key in self.cache:
+                        continue
+                    self._pending[key] = self._executor.submit(self._load, key, connection)
+
+    def get(self, name, code):
+        """Return a cached or in-flight value, or load it now on the caller's thread"""
+        with self._lock:
+            key = (name, self.version, (code,))
+            future = self._pending.get(key)
+            connection = self.connection
+
+        value = self.cache.lookup(key)
+        if value is not MISSING:
+            return value
+
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                pass
+
+        with connection() as conn:
+            value = self.loaders[name](conn, code)
+        self.cache.store(key, value)
+        return value
+
+    def _load(self, key, connection):
+        name, _, (code,) = key
+        try:
+            with connection() as conn:
+                value = self.loaders[name](conn, code)
+            self.cache.store(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def stats(self):
+        """In-flight loads, for diagnostics"""
+        with self._lock:
+            return {'pending': len(self._pending)}
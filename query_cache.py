@@ -0,0 +1,134 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from nutrition_db import DB_PATH, read_db_version
+
+# Returned by QueryCache.lookup when a key is absent or expired
+MISSING = object()
+
+
+def estimate_size(value):
+    """Rough in-memory size of a cached query result, in bytes"""
+    if value is None:
+        return 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """Shared LRU cache of query results, bounded by estimated memory and optionally by age.
+
+    Keys are `(name, db_version, args)` tuples, so a result is never served
+    for a different database build. The cache only moves forward, to the
+    build on disk at `db_path`: entries of the previous build are dropped
+    then, while a session still pinned to a replaced build just misses and
+    leaves the current entries alone. Cached values are shared between
+    sessions and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None, db_path=DB_PATH):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.version = None
+
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def ensure_version(self, version):
+        """Move to the build `version` if it is the one on disk, dropping the older entries.
+
+        Returns whether `version` is the cache's current build; for a replaced
+        build it is False and nothing changes.
+        """
+        with self._lock:
+            if version == self.version:
+                return True
+            if self.version is not None and version != read_db_version(self.db_path):
+                return False
+            self.version = version
+            self._entries.clear()
+            self._total_bytes = 0
+            return True
+
+    def __contains__(self, key):
+        """Presence check that does not count as a hit or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (self.ttl is None or time.monotonic() - entry[2] <= self.ttl)
+
+    def lookup(self, key):
+        """Cached value for key, or MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._discard(key)
+                self._counters['expirations'] += 1
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0]
+
+    def store(self, key, value):
+        """Insert a value, evicting least recently used entries past the memory cap"""
+        size = estimate_size(value)
+        with self._lock:
+            # A result loaded for a build that has since been replaced is not kept
+            if key[1] != self.version:
+                return
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key = next(iter(self._entries))
+                self._discard(old_key)
+                self._counters['evictions'] += 1
+
+    def get_or_load(self, key, load):
+        """Cached value for key, calling load() and caching its result on a miss"""
+        value = self.lookup(key)
+        if value is MISSING:
+            value = load()
+            self.store(key, value)
+        return value
+
+    def _discard(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """Entries, bytes and hit/miss counters, for diagnostics"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._total_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
@@ -1,105 +1,229 @@
-import sqlite3
-import pandas as pd
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from db_swap import shadow_build
+from hebrew_search import FTS_TABLE
+from migrations import SCHEMA_VERSION, apply_migrations
+from nutrient_matrix import NUTRIENT_FIELDS, export_nutrient_matrix, matrix_path
+from sig_figs import PRECISION_TABLE, parse_number_text, write_source_precision
+from source_files import iter_source, sniff_format
 
-def clean_column_names(df):
-    """Clean column names by removing quotes and special characters"""
-    df.columns = df.columns.str.strip().str.replace('"', '').str.replace("'", '')
-    return df
+# Tables a new build must contain (with rows) before it replaces the live database
+REQUIRED_TABLES = ['products', 'units', 'conversions', 'recipes', 'retentions', FTS_TABLE, PRECISION_TABLE]
 
-def read_csv_with_encoding(file_path):
-    """Try reading CSV with different encodings"""
-    encodings = ['utf-8', 'windows-1255', 'iso-8859-8']
-    
-    for encoding in encodings:
-        try:
-            print(f"Trying to read {file_path} with encoding: {encoding}")
-            df = pd.read_csv(file_path, encoding=encoding)
-            df = clean_column_names(df)
-            print(f"Successfully read {file_path} with {encoding}")
-            return df
-        except UnicodeDecodeError:
-            print(f"Failed with {encoding}, trying next...")
-            continue
-        except Exception as e:
-            print(f"Error with {encoding}: {e}")
-            continue
-    
-    raise Exception(f"Could not read {file_path} with any encoding")
+# Ministry of Health export each table is built from, in load order
+SOURCE_FILES = {
+    'products': 'moh_mitzrachim (1).csv',
+    'units': 'moh_yehidot_mida.csv',
+    'conversions': 'moh_yehidot_mida_lemitzrachim.csv',
+    'recipes': 'moh_matkonim_11.7.2022.csv',
+    'retentions': 'retentions_2026_01_21_10_36_11.xls',
+}
+
+# Explicit column types. Keys are INTEGER; columns not listed as integer or
+# text take the table's default type - REAL nutrient values unless stated.
+# food_energy is published in whole kcal and stays INTEGER so its significant
+# figures are counted as before; retention factors are whole percentages.
+TABLE_SCHEMAS = {
+    'products': {
+        'primary_key': ('Code',),
+        'integer': ('Code', 'smlmitzrach', 'food_energy'),
+        'text': ('shmmitzrach', 'tarich_idkun', 'english_name'),
+    },
+    'units': {
+        'primary_key': ('smlmida',),
+        'integer': ('smlmida',),
+        'text': ('shmmida',),
+    },
+    'conversions': {
+        'primary_key': ('mmitzrach', 'mida'),
+        'integer': ('mmitzrach', 'mida'),
+        'without_rowid': True,
+    },
+    'recipes': {
+        'primary_key': ('mmitzrach', 'mitzbsisi'),
+        'integer': ('mmitzrach', 'mitzbsisi', 'is_visible'),
+        'without_rowid': True,
+    },
+    'retentions': {
+        'primary_key': ('retention_code',),
+        'text': ('retention_name', 'hebrew_name'),
+        'default': 'INTEGER',
+    },
+}
+
+# Columns whose significant figures are kept as written in the source file
+# (see sig_figs.PRECISION_TABLE); they are read as text and converted here
+SOURCE_PRECISION = {
+    'products': NUTRIENT_FIELDS,
+}
+
+# Rows parsed per chunk while reading a source file
+CHUNK_ROWS = 5000
+
+# A parsed source file, handed from a parser process to the writer. precision
+# is a list of (key, int8 bytes over precision_fields) rows, or None.
+ParsedSource = namedtuple('ParsedSource', [
+    'table', 'file_path', 'source_format', 'columns', 'rows', 'precision_fields', 'precision', 'seconds'
+])
+
+def column_type(table, column):
+    schema = TABLE_SCHEMAS[table]
+    if column in schema.get('integer', ()):
+        return 'INTEGER'
+    if column in schema.get('text', ()):
+        return 'TEXT'
+    return schema.get('default', 'REAL')
+
+def create_table_sql(table, columns):
+    """CREATE TABLE statement for a source file's columns, typed by TABLE_SCHEMAS"""
+    schema = TABLE_SCHEMAS[table]
+    definitions = [f'"{column}" {column_type(table, column)}' for column in columns]
+    key = ", ".join(f'"{column}"' for column in schema['primary_key'])
+    definitions.append(f"PRIMARY KEY ({key})")
+    options = " WITHOUT ROWID" if schema.get('without_rowid') else ""
+    return f'CREATE TABLE "{table}" (\n    ' + ",\n    ".join(definitions) + f"\n){options}"
+
+def set_bulk_load_pragmas(conn):
+    """Trade durability for speed: a failed build is thrown away, never published"""
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")
+
+def parse_source(table, file_path):
+    """Parse one source file into rows for its typed table (runs in a worker process)"""
+    started = time.perf_counter()
+    source_format = sniff_format(file_path)
+    key_column = TABLE_SCHEMAS[table]['primary_key'][0]
+    precision_fields = list(SOURCE_PRECISION.get(table, ()))
+    columns = None
+    rows = []
+    precision = [] if precision_fields else None
+    for chunk in iter_source(file_path, CHUNK_ROWS, source_format, text_columns=precision_fields):
+        if columns is None:
+            columns = list(chunk.columns)
+            for column in TABLE_SCHEMAS[table]['primary_key']:
+                if column not in columns:
+                    raise ValueError(f"{file_path} has no {column} column")
+            precision_fields = [field for field in precision_fields if field in columns]
+        # Python values (None for missing) so sqlite3 can bind them; the column types do the rest
+        values = chunk[columns].astype(object).where(chunk[columns].notna(), None)
+        if precision is not None:
+            counts = np.zeros((len(values), len(precision_fields)), dtype=np.int8)
+            for position, field in enumerate(precision_fields):
+                cells = [parse_number_text(text) for text in values[field]]
+                values[field] = pd.Series([value for value, _ in cells], index=values.index, dtype=object)
+                counts[:, position] = [sig_figs for _, sig_figs in cells]
+            precision.extend(zip(values[key_column].tolist(), (row.tobytes() for row in counts)))
+        rows.extend(values.itertuples(index=False, name=None))
+    if columns is None:
+        raise ValueError(f"{file_path} is empty")
+    return ParsedSource(
+        table, file_path, source_format, columns, rows, precision_fields, precision, time.perf_counter() - started
+    )
 
-def setup_database():
-    """Import CSV files into SQLite database"""
+def parse_sources(sources, max_workers=None):
+    """Parse every {table: file} source concurrently in worker processes; returns {table: ParsedSource}"""
+    max_workers = max_workers or min(len(sources), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {table: pool.submit(parse_source, table, file_path) for table, file_path in sources.items()}
+        return {table: future.result() for table, future in futures.items()}
+
+def write_table(conn, parsed):
+    """(Re)create a parsed source's typed table and insert its rows"""
+    columns = parsed.columns
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    conn.execute(f'DROP TABLE IF EXISTS "{parsed.table}"')
+    conn.execute(create_table_sql(parsed.table, columns))
+    conn.executemany(
+        f'INSERT INTO "{parsed.table}" ({column_list}) VALUES ({", ".join("?" * len(columns))})',
+        parsed.rows
+    )
+    if parsed.precision is not None:
+        write_source_precision(conn, parsed.precision_fields, parsed.precision)
+
+def print_timings(timings):
+    print("\n=== Timing ===")
+    for stage, seconds in timings:
+        print(f"{stage:<28}{seconds:8.2f}s")
+
+def setup_database(max_workers=None):
+    """Import the source files into SQLite database.
+
+    All files are parsed concurrently in worker processes, so parsing takes as
+    long as the slowest file; a single writer then loads them in one transaction.
+    """
     
     # Database file
     db_path = 'nutrition.db'
-    
-    # Remove existing database if it exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
-        print(f"Removed existing database: {db_path}")
-    
-    # Create connection
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    started = time.perf_counter()
+    timings = []
     
     try:
-        # Read CSV files - note the actual file name with (1)
-        print("\n=== Reading Products File ===")
-        products_df = read_csv_with_encoding('moh_mitzrachim (1).csv')
+        print("\n=== Parsing Source Files ===")
+        parsed = parse_sources(SOURCE_FILES, max_workers)
+        timings.append(('parse (parallel)', time.perf_counter() - started))
+        for source in parsed.values():
+            source_format = source.source_format
+            print(f"Parsed {source.file_path} ({source_format.kind}, {source_format.encoding}, "
+                  f"delimiter {source_format.delimiter!r}): {len(source.rows)} rows in {source.seconds:.2f}s")
+            timings.append((f"  parse {source.table}", source.seconds))
         
-        print("\n=== Reading Units File ===")
-        units_df = read_csv_with_encoding('moh_yehidot_mida.csv')
-        
-        print("\n=== Reading Conversions File ===")
-        conversions_df = read_csv_with_encoding('moh_yehidot_mida_lemitzrachim.csv')
-        
-        print("\n=== Reading Recipes File ===")
-        recipes_df = read_csv_with_encoding('moh_matkonim_11.7.2022.csv')
-        
-        # Create tables and import data
-        print("\n=== Creating Products Table ===")
-        products_df.to_sql('products', conn, if_exists='replace', index=False)
-        print(f"Imported {len(products_df)} products")
-        
-        print("\n=== Creating Units Table ===")
-        units_df.to_sql('units', conn, if_exists='replace', index=False)
-        print(f"Imported {len(units_df)} units")
-        
-        print("\n=== Creating Conversions Table ===")
-        conversions_df.to_sql('conversions', conn, if_exists='replace', index=False)
-        print(f"Imported {len(conversions_df)} conversion records")
-
-        print("\n=== Creating Recipes Table ===")
-        recipes_df.to_sql('recipes', conn, if_exists='replace', index=False)
-        print(f"Imported {len(recipes_df)} recipe records")
+        # The new database is built next to the live one and swapped in only once it is complete
+        with shadow_build(db_path, REQUIRED_TABLES) as conn:
+            set_bulk_load_pragmas(conn)
+            conn.execute("BEGIN")
+            
+            print("\n=== Loading Tables ===")
+            for table in SOURCE_FILES:
+                stage_started = time.perf_counter()
+                rows = len(parsed[table].rows)
+                write_table(conn, parsed[table])
+                elapsed = time.perf_counter() - stage_started
+                timings.append((f"load {table}", elapsed))
+                print(f"Imported {rows} {table} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)")
+            
+            # Indexes, the search index and the other derived tables come from the migrations
+            print("\n=== Applying Migrations ===")
+            for version, description, seconds in apply_migrations(conn):
+                timings.append((f"migration {version}", seconds))
+                print(f"Applied migration {version}: {description} ({seconds:.2f}s)")
+            
+            publish_started = time.perf_counter()
+        timings.append(('commit, validate, publish', time.perf_counter() - publish_started))
         
-        # Create indexes for better performance
-        print("\n=== Creating Indexes ===")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_code ON products(Code)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_units_smlmida ON units(smlmida)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conv_mmitzrach ON conversions(mmitzrach)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conv_mida ON conversions(mida)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recipes_mmitzrach ON recipes(mmitzrach)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recipes_mitzbsisi ON recipes(mitzbsisi)")
+        # Columnar products × nutrients snapshot the app memory-maps
+        stage_started = time.perf_counter()
+        if export_nutrient_matrix(db_path) is not None:
+            print(f"Wrote nutrient matrix: {matrix_path(db_path)}")
+        timings.append(('nutrient matrix', time.perf_counter() - stage_started))
         
-        conn.commit()
+        elapsed = time.perf_counter() - started
+        total_rows = sum(len(source.rows) for source in parsed.values())
+        timings.append(('total', elapsed))
+        print_timings(timings)
+        print(f"\nLoaded {total_rows} rows in {elapsed:.2f}s ({total_rows / elapsed:,.0f} rows/s)")
         
         print("\n=== Database Setup Complete! ===")
-        print(f"Database created: {db_path}")
-        print(f"Tables: products, units, conversions")
+        print(f"Database published: {db_path} (schema version {SCHEMA_VERSION})")
+        print(f"Tables: products, units, conversions, recipes, retentions, products_fts, {PRECISION_TABLE}")
         
         # Display sample counts (avoid printing Hebrew to console)
         print("\n=== Sample Data Info ===")
-        print(f"Products columns: {list(products_df.columns[:5])}...")
-        print(f"Units columns: {list(units_df.columns)}")
-        print(f"Conversions columns: {list(conversions_df.columns)}")
-        print(f"Recipes columns: {list(recipes_df.columns)}")
+        print(f"Products columns: {parsed['products'].columns[:5]}...")
+        print(f"Units columns: {parsed['units'].columns}")
+        print(f"Conversions columns: {parsed['conversions'].columns}")
+        print(f"Recipes columns: {parsed['recipes'].columns}")
+        print(f"Retentions columns: {parsed['retentions'].columns}")
         
     except Exception as e:
         print(f"Error during database setup: {e}")
+        print(f"{db_path} was left unchanged")
         raise
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     setup_database()
@@ -1,65 +1,61 @@
-import sqlite3
-import pandas as pd
 import os
+from db_swap import shadow_build
+from setup_db import SOURCE_FILES, parse_source, write_table
+
+# Tables the updated database must contain (with rows) before it replaces the live one
+REQUIRED_TABLES = ['products', 'retentions']
 
 def setup_retentions_table():
-    """Add retentions table to the existing nutrition database"""
+    """Replace only the retentions table of the existing nutrition database.
+
+    setup_db.py already builds retentions with everything else; this refreshes
+    it alone, through the same parser and typed schema.
+    """
     
     db_path = 'nutrition.db'
-    retentions_file = 'retentions_2026_01_21_10_36_11.xls'
+    retentions_file = SOURCE_FILES['retentions']
     
     # Check if database exists
     if not os.path.exists(db_path):
         print(f"Error: Database {db_path} not found. Run setup_db.py first.")
         return False
     
-    # Read the retentions file (it's actually a UTF-16 TSV file)
+    # Read the retentions file (despite its name it is a UTF-16 TSV; the format is sniffed)
     print(f"Reading {retentions_file}...")
     try:
-        df = pd.read_csv(retentions_file, sep='\t', encoding='utf-16')
-        print(f"Successfully read {len(df)} retention records")
+        parsed = parse_source('retentions', retentions_file)
+        print(f"Successfully read {len(parsed.rows)} retention records")
     except Exception as e:
         print(f"Error reading file: {e}")
         return False
     
-    # Connect to database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
-        # Drop existing table if it exists
-        cursor.execute("DROP TABLE IF EXISTS retentions")
-        
-        # Create the retentions table with the retention data
-        df.to_sql('retentions', conn, if_exists='replace', index=False)
-        print(f"Created retentions table with {len(df)} records")
-        
-        # Create index on retention_code for faster lookups
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_retentions_code ON retentions(retention_code)")
-        print("Created index on retention_code")
-        
-        conn.commit()
-        
-        # Verify the data
-        cursor.execute("SELECT COUNT(*) FROM retentions")
-        count = cursor.fetchone()[0]
-        print(f"\nVerification: {count} records in retentions table")
-        
-        # Show sample data
-        cursor.execute("SELECT retention_code, retention_name, hebrew_name FROM retentions LIMIT 5")
-        print("\nSample data:")
-        for row in cursor.fetchall():
-            print(f"  Code: {row[0]}, Name: {row[1]}, Hebrew: {row[2]}")
+        # Changes go to a copy of the live database, which replaces it only once they are complete
+        with shadow_build(db_path, REQUIRED_TABLES, copy_existing=True) as conn:
+            cursor = conn.cursor()
+            
+            # Recreate the retentions table (keyed on retention_code) with the retention data
+            write_table(conn, parsed)
+            print(f"Created retentions table with {len(parsed.rows)} records")
+            
+            # Verify the data
+            cursor.execute("SELECT COUNT(*) FROM retentions")
+            count = cursor.fetchone()[0]
+            print(f"\nVerification: {count} records in retentions table")
+            
+            # Show sample data
+            cursor.execute("SELECT retention_code, retention_name, hebrew_name FROM retentions LIMIT 5")
+            print("\nSample data:")
+            for row in cursor.fetchall():
+                print(f"  Code: {row[0]}, Name: {row[1]}, Hebrew: {row[2]}")
         
         print("\n=== Retentions table setup complete! ===")
         return True
         
     except Exception as e:
         print(f"Error setting up retentions table: {e}")
-        conn.rollback()
+        print(f"{db_path} was left unchanged")
         return False
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     setup_retentions_table()
@@ -0,0 +1,223 @@
+import math
+
+import numpy as np
+
+# Cells with more significant figures than this are rounded one by one: their
+# scaled value no longer has an exact fractional part in a float64
+MAX_VECTOR_SIG_FIGS = 15
+
+# Powers of ten up to 1e22 are exact in a float64
+MAX_VECTOR_DIGITS = 22
+
+# Significant figures of every product nutrient as written in the source
+# export, one int8 per field in a BLOB per product (see setup_db.py). Once a
+# value is stored as a REAL, "24" and "24.0" can no longer be told apart.
+PRECISION_TABLE = 'source_precision'
+PRECISION_FIELDS_TABLE = 'source_precision_fields'
+
+# Precision recorded for a field the sidecar does not cover
+UNKNOWN_PRECISION = -1
+
+
+def count_sig_figs(value):
+    """Count significant figures of a number"""
+    if value is None:
+        return 0
+    
+    # Convert to string
+    s = str(value).lower()
+    
+    # Handle scientific notation
+    if 'e' in s:
+        base, _ = s.split('e')
+        return count_sig_figs(base)
+    
+    # Remove negative sign
+    s = s.replace('-', '')
+    
+    # Remove decimal point
+    s_no_decimal = s.replace('.', '')
+    
+    # Strip leading zeros
+    s_stripped = s_no_decimal.lstrip('0')
+    
+    if not s_stripped:
+        return 0
+        
+    return len(s_stripped)
+
+
+def round_to_sig_figs(x, sig_figs):
+    """Round a number to a specific number of significant figures"""
+    if x == 0:
+        return 0
+    
+    try:
+        return round(x, sig_figs - int(math.floor(math.log10(abs(x)))) - 1)
+    except (ValueError, OverflowError):
+        return x
+
+
+def calculate_with_sig_figs(original_value, factor):
+    """Calculate new value preserving significant figures"""
+    if original_value is None:
+        return 0
+    
+    try:
+        val_float = float(original_value)
+        if val_float == 0:
+            return 0
+            
+        # Count sig figs from the original representation
+        # If it's an integer in DB (e.g. 24), it comes as 24 or 24.0 depending on pandas
+        # We should try to respect the input type if possible, but here we have values.
+        # We'll use the string representation of the input value.
+        sig_figs = count_sig_figs(original_value)
+        
+        # If sig_figs is 0 (e.g. input was 0), return 0
+        if sig_figs == 0:
+            return 0
+            
+        new_val = val_float * factor
+        rounded_val = round_to_sig_figs(new_val, sig_figs)
+        
+        # Format logic:
+        # If the result is an integer (e.g. 10.0) and original was int-like, maybe show int?
+        # But 10.0 has 3 sig figs, 10 has 2.
+        # We should return a string that represents the sig figs.
+        # However, standard float formatting might be enough for now.
+        # Let's return the rounded float.
+        return rounded_val
+        
+    except (ValueError, TypeError):
+        return 0
+
+
+def to_float_array(values):
+    """float64 array of values; None and anything float() rejects become NaN"""
+    def as_float(value):
+        if value is None:
+            return np.nan
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return np.nan
+    return np.array([as_float(value) for value in values], dtype=np.float64)
+
+
+def parse_number_text(text):
+    """(value, significant figures) of a number as written in a source file.
+
+    Empty cells are (None, 0); text that is not a number is kept as it is,
+    with precision 0.
+    """
+    if not isinstance(text, str):
+        return None, 0
+    text = text.strip()
+    if not text:
+        return None, 0
+    try:
+        value = float(text)
+    except ValueError:
+        return text, 0
+    if value != value:
+        return None, 0
+    return value, min(count_sig_figs(text), 127)
+
+
+def count_sig_figs_array(values):
+    """count_sig_figs of every value, as an int8 array; values float() rejects count as 0"""
+    counts = []
+    for value in values:
+        try:
+            float(value)
+        except (ValueError, TypeError):
+            counts.append(0)
+            continue
+        counts.append(min(count_sig_figs(value), 127))
+    return np.array(counts, dtype=np.int8)
+
+
+def round_to_sig_figs_array(x, sig_figs):
+    """round_to_sig_figs over arrays: each cell of x rounded to the matching cell of sig_figs.
+
+    Gives the same floats as the scalar version. The rare cells where float
+    arithmetic could decide differently from math.log10 and round() - a log10
+    next to an integer, a scaled value next to .5, very long precisions - are
+    finished with the scalar function.
+    """
+    x, sig_figs = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(sig_figs, dtype=np.int64))
+    result = x.copy()
+    active = np.isfinite(x) & (x != 0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log = np.log10(np.abs(x))
+        digits = sig_figs - np.floor(log) - 1
+        scale = 10.0 ** np.clip(np.abs(digits), 0, MAX_VECTOR_DIGITS)
+        scaled = np.where(digits >= 0, x * scale, x / scale)
+        rounded = np.rint(scaled)
+        half_distance = np.abs(np.abs(scaled - np.floor(scaled)) - 0.5)
+        fast = (
+            active
+            & (sig_figs <= MAX_VECTOR_SIG_FIGS)
+            & (np.abs(digits) <= MAX_VECTOR_DIGITS)
+            & (np.abs(log - np.round(log)) > 1e-9)
+            & (half_distance > np.abs(scaled) * 1e-15 + 1e-12)
+        )
+        vector = np.where(digits >= 0, rounded / scale, rounded * scale)
+    result[fast] = vector[fast]
+    for index in zip(*np.nonzero(active & ~fast)):
+        result[index] = round_to_sig_figs(float(x[index]), int(sig_figs[index]))
+    return result
+
+
+def scale_with_sig_figs(values, sig_figs, factor=1.0):
+    """calculate_with_sig_figs over whole vectors or matrices in one call.
+
+    values (float64, NaN for missing) are multiplied by factor - a scalar or
+    anything that broadcasts, such as one factor per row - and rounded to the
+    per-cell precision in sig_figs. Cells with a zero value or zero precision
+    come out as 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sig_figs = np.asarray(sig_figs)
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = values * factor
+    keep = (sig_figs > 0) & (values != 0)
+    return np.where(keep, round_to_sig_figs_array(scaled, sig_figs), 0.0)
+
+
+def display_values(array):
+    """Python numbers for display, with the int 0 calculate_with_sig_figs returns for empty cells"""
+    return [0 if value == 0 else value for value in np.asarray(array, dtype=np.float64).tolist()]
+
+
+def write_source_precision(conn, fields, precision):
+    """(Re)write the precision sidecar: fields in order, and (code, int8 bytes) rows"""
+    conn.execute(f"DROP TABLE IF EXISTS {PRECISION_TABLE}")
+    conn.execute(f"DROP TABLE IF EXISTS {PRECISION_FIELDS_TABLE}")
+    conn.execute(f"CREATE TABLE {PRECISION_FIELDS_TABLE} (position INTEGER PRIMARY KEY, field TEXT NOT NULL)")
+    conn.execute(f"CREATE TABLE {PRECISION_TABLE} (Code INTEGER PRIMARY KEY, sig_figs BLOB NOT NULL)")
+    conn.executemany(f"INSERT INTO {PRECISION_FIELDS_TABLE} (position, field) VALUES (?, ?)", enumerate(fields))
+    conn.executemany(f"INSERT INTO {PRECISION_TABLE} (Code, sig_figs) VALUES (?, ?)", precision)
+
+
+def read_source_precision(conn, fields):
+    """{code: int8 array over fields} from the sidecar, or None for a database without one.
+
+    Fields the sidecar does not cover are UNKNOWN_PRECISION.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (PRECISION_TABLE,)).fetchone() is None:
+        return None
+    stored = [row[0] for row in conn.execute(f"SELECT field FROM {PRECISION_FIELDS_TABLE} ORDER BY position")]
+    stored_index = {field: position for position, field in enumerate(stored)}
+    columns = np.array([stored_index.get(field, -1) for field in fields], dtype=np.intp)
+    covered = columns >= 0
+    precision = {}
+    for code, blob in conn.execute(f"SELECT Code, sig_figs FROM {PRECISION_TABLE}"):
+        counts = np.frombuffer(blob, dtype=np.int8)
+        row = np.full(len(columns), UNKNOWN_PRECISION, dtype=np.int8)
+        row[covered] = counts[columns[covered]]
+        precision[code] = row
+    return precision
+
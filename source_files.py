@@ -0,0 +1,103 @@
+import codecs
+from collections import namedtuple
+
+import pandas as pd
+
+# How a Ministry of Health export is stored: kind is 'text' (CSV/TSV) or 'excel'
+SourceFormat = namedtuple('SourceFormat', ['kind', 'encoding', 'delimiter'])
+
+# Bytes read from the start of a file to recognise its format
+SNIFF_BYTES = 64 * 1024
+
+EXCEL_SIGNATURES = [
+    b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',  # OLE2 compound file (real .xls)
+    b'PK\x03\x04',                        # zip container (.xlsx)
+]
+
+# Checked in order; 'utf-16' consumes the BOM itself
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# Encodings tried on the sniffed bytes of a file without a BOM
+FALLBACK_ENCODINGS = ['utf-8', 'windows-1255', 'iso-8859-8']
+
+DELIMITERS = [',', '\t', ';', '|']
+
+
+def clean_column_names(df):
+    """Clean column names by removing quotes and special characters"""
+    df.columns = df.columns.str.strip().str.replace('"', '').str.replace("'", '')
+    return df
+
+
+def sniff_format(file_path):
+    """Work out a file's container, encoding and delimiter from its first bytes.
+
+    The MoH exports come as UTF-8 CSVs (with or without a BOM), legacy
+    Hebrew code-page CSVs, and UTF-16 TSVs that carry an .xls name; a real
+    Excel workbook is recognised by its signature.
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(SNIFF_BYTES)
+    if not sample:
+        raise ValueError(f"{file_path} is empty")
+
+    if any(sample.startswith(signature) for signature in EXCEL_SIGNATURES):
+        return SourceFormat('excel', None, None)
+
+    text = None
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample)
+            break
+    else:
+        # A multi-byte character may be cut at the end of the sample, so it is not decoded as final
+        final = len(sample) < SNIFF_BYTES
+        for encoding in FALLBACK_ENCODINGS:
+            try:
+                text = codecs.getincrementaldecoder(encoding)().decode(sample, final=final)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError(f"Could not read {file_path} with any encoding")
+
+    header = text.splitlines()[0] if text.strip() else ''
+    delimiter = max(DELIMITERS, key=header.count)
+    if not header.count(delimiter):
+        delimiter = ','
+    return SourceFormat('text', encoding, delimiter)
+
+
+def text_dtypes(text_columns):
+    """read_csv/read_excel dtype keeping the given columns as the text written in the file"""
+    return {column: str for column in text_columns} if text_columns else None
+
+
+def iter_source(file_path, chunk_rows, source_format=None, text_columns=None):
+    """Yield a source file as DataFrames of up to chunk_rows rows, parsing it once.
+
+    Columns named in text_columns are not converted: their cells are the
+    strings written in the file (NaN when empty).
+    """
+    source_format = source_format or sniff_format(file_path)
+    if source_format.kind == 'excel':
+        # Workbooks cannot be streamed; they are read whole and handed out in chunks
+        df = clean_column_names(pd.read_excel(file_path, dtype=text_dtypes(text_columns)))
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+
+    reader = pd.read_csv(
+        file_path,
+        encoding=source_format.encoding,
+        sep=source_format.delimiter,
+        dtype=text_dtypes(text_columns),
+        chunksize=chunk_rows,
+    )
+    with reader:
+        for chunk in reader:
+            yield clean_column_names(chunk)
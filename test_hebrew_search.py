@@ -0,0 +1,31 @@
+import pandas as pd
+
+from hebrew_search import IncrementalSearch
+
+CANDIDATE_COLUMNS = ['Code', 'smlmitzrach', 'shmmitzrach', 'match_name', 'stems', 'score']
+
+
+def remembered(rows, search_term):
+    state = IncrementalSearch()
+    state.remember(search_term, pd.DataFrame(rows, columns=CANDIDATE_COLUMNS), complete=True, db_version='v1')
+    return state
+
+
+def test_narrow_empty_candidate_set():
+    state = remembered([], "zzqq")
+    assert state.can_narrow("zzqq a", 'v1')
+    narrowed = state.narrow("zzqq a")
+    assert narrowed.empty
+    assert list(narrowed.columns) == CANDIDATE_COLUMNS
+
+
+def test_narrow_to_zero_matches():
+    state = remembered([(1, 100, 'חלב', 'חלב', '', -1.0), (2, 200, 'חלב עזים', 'חלב עזים', '', -2.0)], "חלב")
+    narrowed = state.narrow("חלב פרה")
+    assert narrowed.empty
+    assert list(narrowed.columns) == CANDIDATE_COLUMNS
+
+
+def test_narrow_keeps_matching_rows():
+    state = remembered([(1, 100, 'חלב', 'חלב', '', -1.0), (2, 200, 'חלב עזים', 'חלב עזים', '', -2.0)], "חלב")
+    assert state.narrow("חלב ע")['Code'].tolist() == [2]
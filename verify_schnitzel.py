@@ -39,7 +39,7 @@ def verify_schnitzel():
         for _, row in schnitzels.iterrows():
             code = row['Code']
             # Check if it has recipe rows
-            chk = pd.read_sql_query("SELECT count(*) FROM recipes WHERE mmitzrach = ?", conn, params=(float(code),))
+            chk = pd.read_sql_query("SELECT count(*) FROM recipes WHERE mmitzrach = ?", conn, params=(int(code),))
             count = chk.iloc[0,0]
             if count > 0:
                 safe_print(f"FOUND VALID RECIPE! Code: {code} | Name: {row['shmmitzrach']} | Components: {count}")
@@ -51,7 +51,7 @@ def verify_schnitzel():
     if target_code is None:
         print("No Schnitzel recipes found with components. Searching for ANY recipe using the Oil found above...")
         q = "SELECT DISTINCT mmitzrach FROM recipes WHERE mitzbsisi = ? LIMIT 1"
-        res = pd.read_sql_query(q, conn, params=(float(soy_oil_code),))
+        res = pd.read_sql_query(q, conn, params=(int(soy_oil_code),))
         if not res.empty:
             target_code = res.iloc[0]['mmitzrach']
             print(f"Found generic recipe using oil: {target_code}")